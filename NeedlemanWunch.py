@@ -1,5 +1,21 @@
 import sys
 import os
+import argparse
+
+import alignment_paths
+import matrix_export
+import wavefront
+from alignment_cache import cache_key
+from alignment_stats import AlignmentStats, matrix_bytes, phase
+from direction_matrix import DirectionMatrix
+from disk_matrix import MatrixCheckpoint
+from sequence_reader import iterate_sequences
+from substitution_matrix import identity_matrix, load_matrix
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 """
 Modified Needleman Wunch Algorithm to be more easily readable
@@ -7,11 +23,35 @@ Modified Needleman Wunch Algorithm to be more easily readable
 
 
 class NeedlemanWunch:
+    # Fill engine used by align(), either "python", "numpy", "bitparallel", "hirschberg", "banded",
+    # "wavefront" or "auto"
+    # Set on the class to change the default, or pass engine= for one instance
+    # "auto" uses "bitparallel" for unit edit costs and "python" otherwise
+    # "hirschberg" keeps no matrices and finds a single optimal alignment in linear space
+    # "banded" only fills cells near the diagonal, widening the band until the result is exact
+    # "wavefront" fills tiles of the matrices in parallel on wavefront_workers processes
+    engine = "python"
+
+    # Processes used by the wavefront engine, one per CPU when None, and the size of its tiles
+    wavefront_workers = None
+    wavefront_tile_size = wavefront.DEFAULT_TILE_SIZE
+
+    # Store two direction cells per byte instead of one with the python engine
+    # A byte per cell keeps the Direction Matrix in about 8 times less memory than a list
+    # of lists, only packing takes it below a tenth, about 16 times less
+    pack_directions = False
+
     def __init__(self, sequence_a, sequence_b,
                  insertion_cost,
                  deletion_cost,
                  substitution_cost,
-                 match_cost):
+                 match_cost,
+                 engine=None,
+                 max_distance=None,
+                 stats=None,
+                 verbose=True,
+                 matrix_directory=None,
+                 substitution_matrix=None):
 
         # Swap so longer string is along X axis
         if len(sequence_a) > len(sequence_b):
@@ -21,8 +61,9 @@ class NeedlemanWunch:
         self.sequenceA = sequence_a  # Y Sequence
         self.sequenceB = sequence_b  # X Sequence
 
-        print("Sequence A:", sequence_a)
-        print("Sequence B:", sequence_b)
+        if verbose:
+            print("Sequence A:", sequence_a)
+            print("Sequence B:", sequence_b)
 
         # Edit Costs
         self.insert = insertion_cost
@@ -30,20 +71,353 @@ class NeedlemanWunch:
         self.substitution = substitution_cost
         self.match_cost = match_cost
 
-        # Optimal Matrix
-        self.optimal = [[0 for x in range(len(self.sequenceB)+1)]
-                        for x in range(len(self.sequenceA)+1)]
-
-        # Direction Matrix
-        self.direction = [[0 for x in range(len(self.sequenceB)+1)]
-                          for x in range(len(self.sequenceA)+1)]
+        # Cost of pairing each two symbols, match_cost and substitution_cost by default
+        if substitution_matrix is None:
+            substitution_matrix = identity_matrix(match_cost, substitution_cost)
+        self.substitution_matrix = substitution_matrix
+
+        # Sequences as substitution matrix codes
+        self.codes_a = substitution_matrix.encode(self.sequenceA)
+        self.codes_b = substitution_matrix.encode(self.sequenceB)
+
+        if engine is not None:
+            self.engine = engine
+        if self.engine == "auto":
+            self.engine = "bitparallel" if self.has_unit_costs() else "python"
+
+        # Expected upper bound on the alignment cost, used to size the first band
+        self.max_distance = max_distance
+        self.band = None
+
+        # Optional AlignmentStats recording phase durations and work counts
+        self.stats = stats
+
+        # Set by align(), extend_sequence_a then fills the rows it adds
+        self.aligned = False
+
+        # With matrix_directory the python engine keeps its matrices in files there,
+        # resuming the fill of an interrupted align() on the same sequences and costs
+        self.checkpoint = None
+
+        # Matrices of float costs or scores hold floats, others 64 bit integers
+        costs = (insertion_cost, deletion_cost, substitution_cost, match_cost)
+        float_values = any(isinstance(cost, float) for cost in costs) or substitution_matrix.has_float_scores()
+
+        with phase(stats, "allocate"):
+            if matrix_directory is not None:
+                if self.engine != "python":
+                    raise ValueError("Only the python engine can keep its matrices on disk")
+                self.checkpoint = MatrixCheckpoint(matrix_directory,
+                                                   len(self.sequenceA)+1, len(self.sequenceB)+1,
+                                                   cache_key("NeedlemanWunch " + substitution_matrix.name,
+                                                             self.sequenceA, self.sequenceB, *costs),
+                                                   float_costs=float_values)
+                self.optimal = self.checkpoint.optimal
+                self.direction = self.checkpoint.direction
+            elif self.engine == "banded":
+                # Rows are allocated by align_banded once the band width is known
+                first_columns = []
+                self.optimal = BandedMatrix([], first_columns, len(self.sequenceB)+1, float("inf"))
+                self.direction = BandedMatrix([], first_columns, len(self.sequenceB)+1, 0)
+            elif self.engine == "hirschberg":
+                self.optimal = None
+                self.direction = None
+                self.alignment = None
+                self.alignment_score = None
+            elif self.engine == "bitparallel":
+                if not self.has_unit_costs():
+                    raise ValueError("The bitparallel engine only supports unit edit costs")
+                # Rows are rebuilt from the bit-vectors stored by align_bit_parallel
+                self.row_vectors = []
+                self.optimal = BitVectorMatrix(self.row_vectors)
+                self.direction = BitVectorDirections(self)
+            elif self.engine == "wavefront":
+                typecode = "d" if float_values else "q"
+                self.optimal = wavefront.new_matrix(len(self.sequenceA)+1, len(self.sequenceB)+1, typecode)
+                self.direction = wavefront.new_matrix(len(self.sequenceA)+1, len(self.sequenceB)+1, "B")
+            elif self.engine == "numpy":
+                if np is None:
+                    raise ImportError("The numpy engine requires NumPy to be installed")
+                dtype = np.float64 if float_values else np.int64
+
+                # Optimal Matrix
+                self.optimal = np.zeros((len(self.sequenceA)+1, len(self.sequenceB)+1), dtype=dtype)
+
+                # Direction Matrix
+                self.direction = np.zeros((len(self.sequenceA)+1, len(self.sequenceB)+1), dtype=np.uint8)
+            elif self.engine == "python":
+                # Optimal Matrix
+                self.optimal = [[0 for x in range(len(self.sequenceB)+1)]
+                                for x in range(len(self.sequenceA)+1)]
+
+                # Direction Matrix
+                self.direction = DirectionMatrix(len(self.sequenceA)+1, len(self.sequenceB)+1,
+                                                 packed=self.pack_directions)
+            else:
+                raise ValueError("Unknown engine: %r" % (self.engine,))
 
         # Direction Arrows, Direction value in Binary - 3 bits - can be [XYZ] = [UDL] ~ Up, Diagonal, Left
         self.LEFT = 1
         self.DIAGONAL = 2
         self.UP = 4
 
+    def has_unit_costs(self):
+        """
+        True when the costs are plain Levenshtein distance
+        """
+        return (self.insert == 1 and self.delete == 1 and
+                self.substitution_matrix.identity_scores == (0, 1))
+
+    def distance(self):
+        """
+        Returns the cost of the optimal alignment without building the matrices
+        """
+        if self.has_unit_costs():
+            return edit_distance(self.sequenceA, self.sequenceB)
+        return self.score()
+
+    def score(self):
+        """
+        Returns the cost of the optimal alignment keeping only two columns
+        """
+        return self.score_column(self.sequenceA, self.sequenceB)[-1]
+
+    def score_column(self, sequence_a, sequence_b):
+        """
+        Returns the last column of the Optimal Matrix of sequence_a against sequence_b
+        Only the previous and current columns are kept, each len(sequence_a)+1 long,
+            and sequence_a is always the shorter sequence
+        """
+        scores = self.substitution_matrix.scores
+        codes_a = self.substitution_matrix.encode(sequence_a, remember=False)
+        previous = [i * self.delete for i in range(len(sequence_a)+1)]
+        for code in self.substitution_matrix.encode(sequence_b, remember=False):
+            current = [previous[0] + self.insert]
+            for i in range(1, len(sequence_a)+1):
+                score_diagonal = previous[i - 1] + scores[codes_a[i-1]][code]
+                current.append(min(score_diagonal,
+                                   previous[i] + self.insert,
+                                   current[i - 1] + self.delete))
+            previous = current
+        if self.stats is not None:
+            self.stats.count("cells", len(sequence_a) * len(sequence_b))
+        return previous
+
+    def align_linear_space(self):
+        """
+        Hirschberg divide and conquer alignment
+        Stores one optimal alignment in self.alignment as (top, bottom) strings
+        """
+        top, bottom = self.hirschberg(self.sequenceA, self.sequenceB)
+        self.alignment = ("".join(top), "".join(bottom))
+        self.alignment_score = self.alignment_cost(*self.alignment)
+
+    def hirschberg(self, sequence_a, sequence_b):
+        """
+        Splits sequence_b in half and finds where the optimal path crosses the split
+            from a forward score of the left half and a backward score of the right half
+        The halves are then aligned independently, so only columns of sequence_a are kept
+        """
+        if len(sequence_a) == 0:
+            return ['-'] * len(sequence_b), list(sequence_b)
+        if len(sequence_b) == 0:
+            return list(sequence_a), ['-'] * len(sequence_a)
+        if len(sequence_b) == 1:
+            return self.align_single_symbol(sequence_a, sequence_b)
+
+        middle = len(sequence_b) // 2
+        forward = self.score_column(sequence_a, sequence_b[:middle])
+        backward = self.score_column(sequence_a[::-1], sequence_b[middle:][::-1])
+
+        split = 0
+        best = None
+        for i in range(len(sequence_a)+1):
+            total = forward[i] + backward[len(sequence_a) - i]
+            if best is None or total < best:
+                best = total
+                split = i
+
+        top_left, bottom_left = self.hirschberg(sequence_a[:split], sequence_b[:middle])
+        top_right, bottom_right = self.hirschberg(sequence_a[split:], sequence_b[middle:])
+        return top_left + top_right, bottom_left + bottom_right
+
+    def align_single_symbol(self, sequence_a, symbol):
+        """
+        Aligns sequence_a against a one symbol sequence_b, either pairing the symbol
+            with one character of sequence_a or inserting it on its own
+        """
+        best = len(sequence_a) * self.delete + self.insert
+        pair = None
+        for i in range(len(sequence_a)):
+            cost = (len(sequence_a) - 1) * self.delete + self.substitution_matrix.score(sequence_a[i], symbol)
+            if cost < best:
+                best = cost
+                pair = i
+
+        if pair is None:
+            return list(sequence_a) + ['-'], ['-'] * len(sequence_a) + [symbol]
+        bottom = ['-'] * len(sequence_a)
+        bottom[pair] = symbol
+        return list(sequence_a), bottom
+
+    def alignment_cost(self, top, bottom):
+        """
+        Cost of an alignment given as two equal length strings with '-' for gaps
+        """
+        cost = 0
+        for top_symbol, bottom_symbol in zip(top, bottom):
+            if top_symbol == '-':
+                cost += self.insert
+            elif bottom_symbol == '-':
+                cost += self.delete
+            else:
+                cost += self.substitution_matrix.score(top_symbol, bottom_symbol)
+        return cost
+
+    def cheapest_diagonal_cost(self):
+        return self.substitution_matrix.lowest_score()
+
+    def gap_pair_cost(self):
+        """
+        Extra cost of leaving the diagonal by one insertion and one deletion
+            instead of taking one diagonal step
+        """
+        return self.insert + self.delete - self.cheapest_diagonal_cost()
+
+    def initial_band(self):
+        """
+        Band half width for the first banded fill
+        An alignment with E deletions never strays more than E cells from the band
+            of diagonals joining (0, 0) to the end cell, and every deletion pairs with
+            an insertion, so max_distance bounds E
+        Without max_distance the length difference is used
+        """
+        length_difference = len(self.sequenceB) - len(self.sequenceA)
+        if self.max_distance is None:
+            return max(1, length_difference)
+        if self.gap_pair_cost() <= 0:
+            return len(self.sequenceA)
+        spare = (self.max_distance - length_difference * self.insert -
+                 len(self.sequenceA) * self.cheapest_diagonal_cost())
+        # Float costs give a float quotient, the band is a whole number of cells
+        return max(1, int(spare // self.gap_pair_cost()))
+
+    def band_lower_bound(self, band):
+        """
+        Lowest possible cost of an alignment that leaves a band of half width band
+        """
+        length_difference = len(self.sequenceB) - len(self.sequenceA)
+        return (length_difference * self.insert +
+                len(self.sequenceA) * self.cheapest_diagonal_cost() +
+                (band + 1) * self.gap_pair_cost())
+
+    def align_banded(self):
+        """
+        Fills only the cells within band of the diagonals joining (0, 0) to the end cell
+        If an alignment outside the band could still be cheaper, the band is doubled
+            and the fill repeated, so the result is always exact
+        """
+        band = self.initial_band()
+        while True:
+            self.fill_band(band)
+            if band >= len(self.sequenceA) or self.gap_pair_cost() <= 0:
+                break
+            score = self.optimal[len(self.sequenceA)][len(self.sequenceB)]
+            if score <= self.band_lower_bound(band):
+                break
+            band *= 2
+        self.band = band
+
+    def fill_band(self, band):
+        length_difference = len(self.sequenceB) - len(self.sequenceA)
+        optimal_rows = self.optimal.rows
+        direction_rows = self.direction.rows
+        first_columns = self.optimal.first_columns
+        del optimal_rows[:], direction_rows[:], first_columns[:]
+
+        substitution_scores = self.substitution_matrix.scores
+        previous = None
+        previous_first = previous_last = 0
+        for i in range(len(self.sequenceA)+1):
+            first = max(0, i - band)
+            last = min(len(self.sequenceB), i + length_difference + band)
+            row = [0] * (last - first + 1)
+            directions = bytearray(last - first + 1)
+
+            for j in range(first, last+1):
+                if i == 0 and j == 0:
+                    directions[0] = self.DIAGONAL
+                    continue
+                scores = []
+                if j > first:
+                    scores.append((row[j - 1 - first] + self.insert, self.LEFT))
+                if i > 0 and j > 0 and previous_first <= j - 1 <= previous_last:
+                    scores.append((previous[j - 1 - previous_first] +
+                                   substitution_scores[self.codes_a[i-1]][self.codes_b[j-1]], self.DIAGONAL))
+                if i > 0 and previous_first <= j <= previous_last:
+                    scores.append((previous[j - previous_first] + self.delete, self.UP))
+
+                best = min(score for score, arrow in scores)
+                row[j - first] = best
+                directions[j - first] = sum(arrow for score, arrow in scores if score == best)
+
+            optimal_rows.append(row)
+            direction_rows.append(directions)
+            first_columns.append(first)
+            previous, previous_first, previous_last = row, first, last
+            if self.stats is not None:
+                self.stats.count("cells", len(row))
+
     def align(self):
+        with phase(self.stats, "align"):
+            if self.engine == "banded":
+                self.align_banded()
+            elif self.engine == "hirschberg":
+                self.align_linear_space()
+            elif self.engine == "numpy":
+                self.align_numpy()
+            elif self.engine == "bitparallel":
+                self.align_bit_parallel()
+            elif self.engine == "wavefront":
+                self.align_wavefront()
+            else:
+                self.align_python()
+        self.aligned = True
+
+        if self.stats is not None:
+            # The banded and hirschberg engines count the cells of each of their passes
+            if self.engine in ("python", "numpy", "bitparallel", "wavefront"):
+                self.stats.count("cells", len(self.sequenceA) * len(self.sequenceB))
+            self.stats.count("bytes_allocated", matrix_bytes(self.optimal) + matrix_bytes(self.direction))
+
+    def extend_sequence_a(self, symbols):
+        """
+        Appends symbols to sequenceA, filling only the new rows once aligned
+        Rows never depend on the symbols below them, so the matrices and alignments
+            are the same as aligning the longer sequence from scratch
+        sequenceA is the row sequence, the shorter one when the aligner was built
+        """
+        if self.engine != "python" or self.checkpoint is not None:
+            raise ValueError("Only the python engine with its matrices in memory can be extended")
+        first_row = len(self.sequenceA) + 1
+        self.sequenceA += symbols
+        self.codes_a += self.substitution_matrix.encode(symbols, remember=False)
+        with phase(self.stats, "allocate"):
+            self.optimal.extend([0 for x in range(len(self.sequenceB)+1)]
+                                for x in range(len(symbols)))
+            self.direction.add_rows(len(symbols))
+        if not self.aligned:
+            return
+
+        with phase(self.stats, "align"):
+            for i in range(first_row, len(self.sequenceA)+1):
+                self.optimal[i][0] = self.optimal[i - 1][0] + self.delete
+                self.direction[i][0] = self.UP
+            self.fill_rows(first_row)
+        if self.stats is not None:
+            self.stats.count("cells", len(symbols) * len(self.sequenceB))
+
+    def fill_first_row_and_column(self):
         # Compute insertions and deletions for 1st row and 1st column
         # Set the values of row 0 and column 0
         self.optimal[0][0] = 0
@@ -57,14 +431,34 @@ class NeedlemanWunch:
             self.optimal[0][i] = self.optimal[0][i - 1] + self.insert
             self.direction[0][i] = self.LEFT
 
+    def align_wavefront(self):
+        """
+        Fills the same matrices as align_python, tile by tile on a process pool
+        """
+        self.fill_first_row_and_column()
+        wavefront.fill_wavefront(self, self.wavefront_workers, self.wavefront_tile_size)
+
+    def align_python(self):
+        # Rows before first_row were filled by an earlier, interrupted align()
+        first_row = 1 if self.checkpoint is None else self.checkpoint.first_row
+
+        if first_row == 1:
+            self.fill_first_row_and_column()
+        self.fill_rows(first_row)
+
+    def fill_rows(self, first_row):
+        """
+        Computes the cells of rows first_row onwards, the rows above already filled
+        """
         # Compute the rest of the cells
-        for i in range(1, len(self.sequenceA)+1):
+        for i in range(first_row, len(self.sequenceA)+1):
+            # Costs of pairing symbol i of A with each symbol of B
+            scores = self.substitution_matrix.scores[self.codes_a[i-1]]
+            # Taken once per row, indexing the matrix for each cell builds a new row view
+            direction_row = self.direction[i]
             for j in range(1, len(self.sequenceB)+1):
 
-                if self.sequenceA[i-1] == self.sequenceB[j-1]:
-                    score_diagonal = self.optimal[i - 1][j - 1] + self.match_cost  # If Symbols Match
-                else:
-                    score_diagonal = self.optimal[i - 1][j - 1] + self.substitution  # Otherwise Substitute
+                score_diagonal = self.optimal[i - 1][j - 1] + scores[self.codes_b[j-1]]  # Match or Substitute
 
                 score_left = self.optimal[i][j - 1] + self.insert
                 score_up = self.optimal[i - 1][j] + self.delete
@@ -72,103 +466,455 @@ class NeedlemanWunch:
                 # Take the minimum of these scores
                 self.optimal[i][j] = min(score_diagonal, score_left, score_up)
 
-                self.direction[i][j] = 0
+                direction = 0
                 if self.optimal[i][j] == score_left:
-                    self.direction[i][j] += self.LEFT
+                    direction += self.LEFT
                 if self.optimal[i][j] == score_diagonal:
-                    self.direction[i][j] += self.DIAGONAL
+                    direction += self.DIAGONAL
                 if self.optimal[i][j] == score_up:
-                    self.direction[i][j] += self.UP
+                    direction += self.UP
+                direction_row[j] = direction
                 # end of align
+            if self.checkpoint is not None:
+                self.checkpoint.completed_row(i)
 
-    def output_matrices(self):
+    def align_numpy(self):
         """
-        Prints out Optimal and Direction Matrices
+        Fills the same Optimal and Direction Matrices as align, one row at a time
+        The diagonal and up scores of a row only depend on the previous row, so they
+            are computed as whole array operations
+        The left score chains along the row, so it is resolved with a prefix-min scan:
+            optimal[i][j] = min over k <= j of (best[k] + (j - k) * insert)
+        Float sums depend on their order, so with float costs the first row and
+            column are running sums and the left chain adds insert one cell at a
+            time, exactly as align_python does
         """
+        codes_a = np.frombuffer(self.codes_a, dtype=np.uint8)
+        codes_b = np.frombuffer(self.codes_b, dtype=np.uint8)
+        table = self.substitution_matrix.table()
+
+        optimal = self.optimal
+        direction = self.direction
+
+        # Set the values of row 0 and column 0, as running sums like align_python
+        optimal[0, 0] = 0
+        optimal[0, 1:] = np.cumsum(np.full(len(codes_b), self.insert, dtype=optimal.dtype))
+        optimal[1:, 0] = np.cumsum(np.full(len(codes_a), self.delete, dtype=optimal.dtype))
+        direction[0, 0] = self.DIAGONAL
+        direction[1:, 0] = self.UP
+        direction[0, 1:] = self.LEFT
+
+        # Cost of reaching column j purely by insertions, used to turn the left chain into a running minimum
+        insert_ramp = np.arange(len(codes_b)+1, dtype=optimal.dtype) * self.insert
+        row = np.empty(len(codes_b)+1, dtype=optimal.dtype)
+        exact_ramp = optimal.dtype.kind in "iu"
+
+        for i in range(1, len(codes_a)+1):
+            previous = optimal[i - 1]
+            edit_costs = table[codes_a[i-1]][codes_b]
+            score_diagonal = previous[:-1] + edit_costs
+            score_up = previous[1:] + self.delete
+
+            row[0] = optimal[i, 0]
+            np.minimum(score_diagonal, score_up, out=row[1:])
+            if exact_ramp:
+                row -= insert_ramp
+                np.minimum.accumulate(row, out=row)
+                row += insert_ramp
+            else:
+                row[:] = chain_left(row.tolist(), self.insert)
+            optimal[i] = row
 
+            best = row[1:]
+            score_left = row[:-1] + self.insert
+            direction[i, 1:] = ((best == score_left) * self.LEFT +
+                                (best == score_diagonal) * self.DIAGONAL +
+                                (best == score_up) * self.UP)
+            # end of align_numpy
+
+    def align_bit_parallel(self):
         """
-        Print Optimal Matrix
+        Runs the Myers bit-vector edit distance over the rows, keeping only the
+            two row delta vectors for each row instead of every cell
+        self.optimal and self.direction then rebuild the cells they are asked for,
+            so only the rows a traceback visits are ever expanded
         """
-        print("\n", "_"*7, "Optimal Matrix", "_"*7)
-        print("\t\t" + "\t".join(list(self.sequenceB)))
-        for i in range(0, len(self.sequenceA)+1):
+        del self.row_vectors[:]
+        self.row_vectors.extend(edit_distance_rows(self.sequenceA, self.sequenceB))
 
-            if i >= 1:
-                print(self.sequenceA[i-1] + '\t', end="")
-            else:
-                print('\t', end="")
-            for j in range(0, len(self.sequenceB)+1):
-                print(str(self.optimal[i][j]) + '\t', end=""),
-            print("")
+    def output_matrices(self, output_file=None, window=matrix_export.DEFAULT_WINDOW, around="end"):
+        """
+        Prints out Optimal and Direction Matrices
+        Matrices larger than window are cut down to the cells around the end cell,
+            or around the first traceback path with around="path"
+        """
+        if self.optimal is None:
+            print("\nNo matrices are kept by the %s engine" % self.engine, file=output_file)
+            return
+        matrix_export.write_matrices(self, output_file, window, around)
 
+    def is_origin(self, d, a):
+        return d == 0 and a == 0
+
+    def iterate_alignments(self, limit=None):
         """
-        Print Direction Matrix
+        Lazily yields (top, bottom) for each co-optimal alignment, at most limit of them
         """
-        print("\n", "_"*7, "Direction Matrix", "_"*7)
-        print("\t\t" + "\t".join(list(self.sequenceB)))
-        for i in range(0, len(self.sequenceA)+1):
-            if i >= 1:
-                print(self.sequenceA[i-1] + '\t', end=""),
-            else:
-                print('\t', end=""),
-            for j in range(0, len(self.sequenceB)+1):
-                print(str(self.direction[i][j]) + '\t', end=""),
-            print("")
+        for top, bottom, d, a in alignment_paths.iterate_alignments(
+                self, len(self.sequenceA), len(self.sequenceB), self.is_origin, limit, self.stats):
+            yield top, bottom
+
+    def count_alignments(self):
+        """
+        Number of co-optimal alignments, counted without walking each of them
+        """
+        return alignment_paths.count_alignments(
+            self, len(self.sequenceA), len(self.sequenceB), self.is_origin, self.stats)
 
-    def recurse_tree(self, d, a, tail_top, tail_bottom):
+    def recurse_tree(self, d, a, tail_top, tail_bottom, limit=None):
         """
         Follows Arrows Through Direction Matrix From End to Origin
         If a cell has multiple arrows, paths diverge and alignment is
             found for each possible path
+        Paths are walked with an explicit stack and printed as they are found
         """
-
-        if d == 0 and a == 0:
-
+        with phase(self.stats, "traceback"):
+            for top, bottom, start_d, start_a in alignment_paths.iterate_alignments(
+                    self, d, a, self.is_origin, limit, self.stats):
+                print("___Alignment Output___")
+                print(top + tail_top)
+                print(bottom + tail_bottom)
+                print("")
+
+    def output_alignments(self, limit=None):
+        print("\n___Outputting Alignments___\n")
+        if self.engine == "hirschberg":
             print("___Alignment Output___")
-            print(tail_top)
-            print(tail_bottom)
+            print(self.alignment[0])
+            print(self.alignment[1])
             print("")
-        else:
-            tc = ''
-            if d >= 0:
-                tc = self.sequenceA[d-1]
-            bc = ''
-            if a >= 0:
-                bc = self.sequenceB[a-1]
-
-            if (self.direction[d][a] & self.LEFT) == self.LEFT:  # If Left Arrow
-                self.recurse_tree(d, a - 1, '-' + tail_top, bc + tail_bottom)
-
-            if (self.direction[d][a] & self.DIAGONAL) == self.DIAGONAL:  # If Diagonal Arrow
-                self.recurse_tree(d - 1, a - 1, tc + tail_top, bc + tail_bottom)
-
-            if (self.direction[d][a] & self.UP) == self.UP:  # If Up Arrow
-                self.recurse_tree(d - 1, a, tc + tail_top, '-' + tail_bottom)
-            # end of recurse tree
-
-    def output_alignments(self):
-        print("\n___Outputting Alignments___\n")
-        self.recurse_tree(len(self.sequenceA), len(self.sequenceB), '', '')
+            return
+        self.recurse_tree(len(self.sequenceA), len(self.sequenceB), '', '', limit)
+
+
+class BandedRow:
+    """
+    One row of a banded matrix, cells outside the band read as fill
+    """
+    def __init__(self, values, first, length, fill):
+        self.values = values
+        self.first = first
+        self.length = length
+        self.fill = fill
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, j):
+        if j < 0:
+            j += self.length
+        if not 0 <= j < self.length:
+            raise IndexError("row index out of range")
+        if self.first <= j < self.first + len(self.values):
+            return self.values[j - self.first]
+        return self.fill
+
+
+class BandedMatrix:
+    """
+    Matrix that keeps, for each row, only the cells from first_columns[i] onwards
+    """
+    def __init__(self, rows, first_columns, columns, fill):
+        self.rows = rows
+        self.first_columns = first_columns
+        self.columns = columns
+        self.fill = fill
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, i):
+        return BandedRow(self.rows[i], self.first_columns[i], self.columns, self.fill)
+
+    @property
+    def nbytes(self):
+        return sys.getsizeof(self.rows) + sum(sys.getsizeof(row) for row in self.rows)
+
+
+class BitVectorRow:
+    """
+    One row of the optimal matrix, stored as its bit-vector deltas
+    Bit j-1 of positive (negative) is set when optimal[i][j] - optimal[i][j-1] is +1 (-1)
+    """
+    def __init__(self, start, positive, negative, length):
+        self.start = start
+        self.positive = positive
+        self.negative = negative
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, j):
+        if j < 0:
+            j += self.length
+        if not 0 <= j < self.length:
+            raise IndexError("row index out of range")
+        low_bits = (1 << j) - 1
+        return (self.start +
+                bin(self.positive & low_bits).count("1") -
+                bin(self.negative & low_bits).count("1"))
+
+
+def chain_left(row, insert):
+    """
+    Lowers each cell of row to the cell before it plus insert where that is
+        cheaper, adding one cell at a time
+    """
+    for j in range(1, len(row)):
+        score_left = row[j - 1] + insert
+        if score_left < row[j]:
+            row[j] = score_left
+    return row
+
+
+class BitVectorMatrix:
+    """
+    Optimal Matrix view over the row vectors produced by edit_distance_rows
+    """
+    def __init__(self, row_vectors):
+        self.row_vectors = row_vectors
+
+    @property
+    def nbytes(self):
+        return sys.getsizeof(self.row_vectors) + sum(sys.getsizeof(positive) + sys.getsizeof(negative)
+                                                     for positive, negative, length in self.row_vectors)
+
+    def __len__(self):
+        return len(self.row_vectors)
+
+    def __getitem__(self, i):
+        positive, negative, length = self.row_vectors[i]
+        if i < 0:
+            i += len(self.row_vectors)
+        return BitVectorRow(i, positive, negative, length)
+
+
+class BitVectorDirectionRow:
+    def __init__(self, aligner, i):
+        self.aligner = aligner
+        self.i = i
+        self.row = aligner.optimal[i]
+        if i > 0:
+            self.previous = aligner.optimal[i-1]
+            # Same pair costs the bit-vectors were chosen for, see has_unit_costs
+            self.scores = aligner.substitution_matrix.scores[aligner.codes_a[i-1]]
+
+    def __len__(self):
+        return len(self.row)
+
+    def __getitem__(self, j):
+        aligner = self.aligner
+        i = self.i
+        if j < 0:
+            j += len(self.row)
+        if i == 0 and j == 0:
+            return aligner.DIAGONAL
+        if i == 0:
+            return aligner.LEFT
+        if j == 0:
+            return aligner.UP
+
+        score_diagonal = self.previous[j-1] + self.scores[aligner.codes_b[j-1]]
+        score_left = self.row[j-1] + aligner.insert
+        score_up = self.previous[j] + aligner.delete
+        optimal = self.row[j]
+
+        direction = 0
+        if optimal == score_left:
+            direction += aligner.LEFT
+        if optimal == score_diagonal:
+            direction += aligner.DIAGONAL
+        if optimal == score_up:
+            direction += aligner.UP
+        return direction
+
+
+class BitVectorDirections:
+    """
+    Direction Matrix view that recomputes the arrows of a cell from its
+        neighbours in the bit-vector Optimal Matrix
+    """
+    def __init__(self, aligner):
+        self.aligner = aligner
+
+    # Nothing is stored, every arrow is recomputed from the Optimal Matrix
+    nbytes = 0
+
+    def __len__(self):
+        return len(self.aligner.optimal)
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self.aligner.optimal)
+        return BitVectorDirectionRow(self.aligner, i)
+
+
+def edit_distance_rows(sequence_a, sequence_b):
+    """
+    Myers / Hyyro bit-parallel Levenshtein distance, variable names follow Myers (1999)
+    Bit j-1 of each vector holds column j of sequence_b, so a whole row is
+        updated with a handful of integer operations
+    Yields (pv, mv, length) row deltas for rows 0 to len(sequence_a)
+    """
+    length = len(sequence_b) + 1
+    mask = (1 << len(sequence_b)) - 1
+
+    # Bit j is set where sequence_b[j] is the character
+    peq = {}
+    for j, character in enumerate(sequence_b):
+        peq[character] = peq.get(character, 0) | (1 << j)
+
+    # Row 0 is all insertions, so every step along it is +1
+    pv = mask
+    mv = 0
+    yield pv, mv, length
+
+    for character in sequence_a:
+        eq = peq.get(character, 0)
+        xv = eq | mv
+        xh = (((eq & pv) + pv) ^ pv) | eq
+        ph = mv | (~(xh | pv) & mask)
+        mh = pv & xh
+
+        # Column 0 always steps down by one deletion
+        ph = ((ph << 1) | 1) & mask
+        mh = (mh << 1) & mask
+        pv = mh | (~(xv | ph) & mask)
+        mv = ph & xv
+        yield pv, mv, length
+
+
+def edit_distance(sequence_a, sequence_b):
+    """
+    Unit cost global alignment score using a few integers of working memory
+    """
+    row = 0
+    for row, (pv, mv, length) in enumerate(edit_distance_rows(sequence_a, sequence_b)):
+        pass
+    return row + bin(pv).count("1") - bin(mv).count("1")
+
+
+def global_align(sequence_a, sequence_b,
+                 insertion_cost,
+                 deletion_cost,
+                 substitution_cost,
+                 match_cost,
+                 engine="auto",
+                 stats=None,
+                 cache=None,
+                 substitution_matrix=None):
+    """
+    Aligns two sequences without printing and returns a compact result
+        {"distance", "alignment_a", "alignment_b"} holding the first co-optimal alignment
+    With an AlignmentCache the result is looked up before filling any matrix
+    substitution_matrix holds the costs of pairing two symbols, replacing match_cost and
+        substitution_cost
+    As in NeedlemanWunch, alignment_a is the alignment of the shorter sequence
+    """
+    if cache is not None:
+        # Engines may return different co-optimal alignments, hirschberg in particular
+        algorithm = "global_align:%s" % engine
+        if substitution_matrix is not None:
+            algorithm += " " + substitution_matrix.name
+        key = cache_key(algorithm, sequence_a, sequence_b,
+                        insertion_cost, deletion_cost, substitution_cost, match_cost)
+        result = cache.get(key)
+        if result is None:
+            result = global_align(sequence_a, sequence_b,
+                                  insertion_cost, deletion_cost, substitution_cost, match_cost,
+                                  engine, stats, substitution_matrix=substitution_matrix)
+            cache.put(key, result)
+        return result
+
+    needleman_wunch = NeedlemanWunch(sequence_a, sequence_b,
+                                     insertion_cost, deletion_cost, substitution_cost, match_cost,
+                                     engine=engine, stats=stats, verbose=False,
+                                     substitution_matrix=substitution_matrix)
+    needleman_wunch.align()
+    if needleman_wunch.engine == "hirschberg":
+        alignment_a, alignment_b = needleman_wunch.alignment
+        distance = needleman_wunch.alignment_score
+    else:
+        alignment_a, alignment_b = next(needleman_wunch.iterate_alignments(limit=1))
+        distance = needleman_wunch.optimal[len(needleman_wunch.sequenceA)][len(needleman_wunch.sequenceB)]
+        if hasattr(distance, "item"):
+            # NumPy scalars are not JSON serialisable
+            distance = distance.item()
+    return {"distance": distance, "alignment_a": alignment_a, "alignment_b": alignment_b}
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Global alignment of the first two sequences of a file")
+    parser.add_argument("input_file", nargs="?", default="input.txt",
+                        help="file in the inputs folder")
+    parser.add_argument("--matrix-window", type=int, default=matrix_export.DEFAULT_WINDOW,
+                        help="largest number of matrix rows and columns printed, 0 prints them all")
+    parser.add_argument("--dump-matrices", metavar="PREFIX", default=None,
+                        help="save the full matrices to PREFIX_optimal.npy and PREFIX_direction.npy")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="fill the matrices on this many processes with the wavefront engine")
+    parser.add_argument("--matrix-dir", default=None,
+                        help="keep the matrices in files in this directory, resuming an interrupted run")
+    parser.add_argument("--matrix", default=None, metavar="NAME",
+                        help="score symbol pairs with a substitution matrix from the matrices folder, "
+                             "such as DNA or BLOSUM62, or in the file NAME; its scores are negated into costs")
+    parser.add_argument("--gap-cost", type=int, default=1,
+                        help="cost of an insertion or deletion")
+    parser.add_argument("--stats", nargs="?", const="-", default=None, metavar="JSON_FILE",
+                        help="print phase timings and work counts, or write them to JSON_FILE")
+    return parser.parse_args()
 
 
 def main():
-    try:
-        file_name = sys.argv[1]
-    except IndexError:
-        file_name = "input.txt"
-    with open(os.path.join('inputs', file_name)) as input_file:
-        sequence_a = input_file.readline().rstrip()
-        sequence_b = input_file.readline().rstrip()
+    arguments = parse_arguments()
+    stats = AlignmentStats() if arguments.stats else None
+
+    sequences = iterate_sequences(os.path.join('inputs', arguments.input_file))
+    sequence_a = next(sequences, "")
+    sequence_b = next(sequences, "")
+
+    if arguments.matrix_dir:
+        engine = "python"
+    elif arguments.workers:
+        engine = "wavefront"
+        NeedlemanWunch.wavefront_workers = arguments.workers
+    else:
+        engine = "auto"
+
+    substitution_matrix = None
+    if arguments.matrix:
+        # Matrices hold similarity scores, NeedlemanWunch minimises costs
+        substitution_matrix = load_matrix(arguments.matrix).negated()
 
     needleman_wunch = NeedlemanWunch(sequence_a=sequence_a,
                                      sequence_b=sequence_b,
-                                     insertion_cost=1,
-                                     deletion_cost=1,
+                                     insertion_cost=arguments.gap_cost,
+                                     deletion_cost=arguments.gap_cost,
                                      substitution_cost=1,
-                                     match_cost=0)
+                                     match_cost=0,
+                                     engine=engine,
+                                     stats=stats,
+                                     matrix_directory=arguments.matrix_dir,
+                                     substitution_matrix=substitution_matrix)
     needleman_wunch.align()
-    needleman_wunch.output_matrices()
+    needleman_wunch.output_matrices(window=arguments.matrix_window or None)
     needleman_wunch.output_alignments()
+    if arguments.dump_matrices:
+        matrix_export.save_matrices(needleman_wunch, arguments.dump_matrices)
+
+    if stats is not None:
+        stats.report(arguments.stats)
 
 if __name__ == "__main__":
     main()
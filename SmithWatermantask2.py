@@ -1,16 +1,50 @@
-import sys
 import os
+import io
+import sys
+import argparse
+import itertools
+import collections
+import multiprocessing
+
+import alignment_paths
+import matrix_export
+from alignment_cache import DEFAULT_CAPACITY, AlignmentCache, cache_key
+from alignment_stats import AlignmentStats, matrix_bytes, phase
+from direction_matrix import DirectionMatrix
+from disk_matrix import MatrixCheckpoint
+from placement_sort import DEFAULT_MEMORY_BUDGET, PlacementSorter, ReadPlacement
+from sequence_reader import iterate_sequences
+from substitution_matrix import identity_matrix, load_matrix
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 """
 Prints out assembled sequence and saves to output.txt
 Provide command line path to file or select from files in input folder
+The first sequence is the template, the rest are reads. The input may be
+plain lines, FASTA or FASTQ, optionally gzip compressed
+
+Reads are streamed: each alignment is reduced to a ReadPlacement as soon as it
+is done, placements beyond --memory-budget MB are sorted on disk, and the
+contig is written out as it is merged
 
 Usage:
-python smithwatermantask2.py [input_file]
+python smithwatermantask2.py [input_file] [--workers N] [--chunk-size N] [--seed-length K] [--stats [JSON_FILE]]
+                             [--cache CACHE_FILE] [--cache-size N] [--x-drop X] [--matrix NAME]
+                             [--memory-budget MB]
 
 Example:
 python smithwatermantask2.py sequence_input.txt
 
+Example, aligning reads on 4 processes:
+python smithwatermantask2.py sequence_input.txt --workers 4
+
+Example, reusing the read alignments of earlier runs:
+python smithwatermantask2.py sequence_input.txt --cache alignments.sqlite
+
 Example:
 python smithwatermantask2.py
 
@@ -27,11 +61,21 @@ python smithwatermantask2.py
 
 
 class SmithWaterman:
+    # Store two direction cells per byte instead of one
+    # A byte per cell keeps the Direction Matrix in about 8 times less memory than a list
+    # of lists, only packing takes it below a tenth, about 16 times less
+    pack_directions = False
+
     def __init__(self, sequence_a, sequence_b,
                  insertion_cost,
                  deletion_cost,
                  substitution_cost,
-                 match_cost):
+                 match_cost,
+                 score_only=False,
+                 stats=None,
+                 x_drop=None,
+                 matrix_directory=None,
+                 substitution_matrix=None):
 
         # Input Sequences
         self.sequenceA = sequence_a  # Y Sequence
@@ -43,13 +87,60 @@ class SmithWaterman:
         self.substitution = substitution_cost
         self.match_cost = match_cost
 
-        # Optimal Matrix
-        self.optimal = [[0 for x in range(len(self.sequenceB)+1)]
-                        for x in range(len(self.sequenceA)+1)]
+        # Score of pairing each two symbols, match_cost and substitution_cost by default
+        if substitution_matrix is None:
+            substitution_matrix = identity_matrix(match_cost, substitution_cost)
+        self.substitution_matrix = substitution_matrix
+
+        # Sequences as substitution matrix codes
+        self.codes_a = substitution_matrix.encode(self.sequenceA)
+        self.codes_b = substitution_matrix.encode(self.sequenceB)
+
+        # Score only mode keeps two rows instead of the full matrices
+        self.score_only = score_only
 
-        # Direction Matrix
-        self.direction = [[0 for x in range(len(self.sequenceB)+1)]
-                          for x in range(len(self.sequenceA)+1)]
+        # Optional AlignmentStats recording phase durations and work counts
+        self.stats = stats
+
+        # X-drop mode stops extending cells scoring more than x_drop below the best so far
+        # exact is False when a cell it did not extend could still have changed the result,
+        # align() then fills again without X-drop so the result is never used
+        self.x_drop = x_drop
+        self.exact = True
+        self.cells_computed = len(sequence_a) * len(sequence_b)
+
+        # Set by align(), extend_sequence_a then fills the rows it adds
+        self.aligned = False
+
+        # With matrix_directory the matrices are kept in files there, resuming the
+        # fill of an interrupted align() on the same sequences and costs
+        self.checkpoint = None
+
+        if score_only:
+            self.optimal = None
+            self.direction = None
+        elif matrix_directory is not None:
+            if x_drop is not None:
+                raise ValueError("X-drop mode cannot keep its matrices on disk")
+            with phase(stats, "allocate"):
+                costs = (insertion_cost, deletion_cost, substitution_cost, match_cost)
+                self.checkpoint = MatrixCheckpoint(matrix_directory,
+                                                   len(self.sequenceA)+1, len(self.sequenceB)+1,
+                                                   cache_key("SmithWatermantask2.SmithWaterman " + substitution_matrix.name,
+                                                             self.sequenceA, self.sequenceB, *costs),
+                                                   float_costs=any(isinstance(cost, float) for cost in costs) or
+                                                   substitution_matrix.has_float_scores())
+                self.optimal = self.checkpoint.optimal
+                self.direction = self.checkpoint.direction
+        else:
+            with phase(stats, "allocate"):
+                # Optimal Matrix
+                self.optimal = [[0 for x in range(len(self.sequenceB)+1)]
+                                for x in range(len(self.sequenceA)+1)]
+
+                # Direction Matrix
+                self.direction = DirectionMatrix(len(self.sequenceA)+1, len(self.sequenceB)+1,
+                                                 packed=self.pack_directions)
 
         # Direction Arrows, Direction value in Binary - 3 bits - can be [XYZ] = [UDL] ~ Up, Diagonal, Left
         self.LEFT = 1
@@ -58,30 +149,103 @@ class SmithWaterman:
 
         self.max_value = 0
         self.max_indices = [0, 0]
+        if self.checkpoint is not None and self.checkpoint.state:
+            self.max_value = self.checkpoint.state["max_value"]
+            self.max_indices = self.checkpoint.state["max_indices"]
         self.relative_position = NotImplemented
+        self.start_indices = None
 
     def align(self):
+        with phase(self.stats, "align"):
+            if self.x_drop is not None:
+                self.align_x_drop()
+                if not self.exact:
+                    self.align_without_x_drop()
+            elif self.score_only:
+                self.align_score_only()
+            else:
+                self.align_full()
+        self.aligned = True
+        if self.stats is not None:
+            self.stats.count("cells", self.cells_computed)
+            if not self.exact:
+                self.stats.count("x_drop_inexact")
+            self.stats.count("bytes_allocated", matrix_bytes(self.optimal) + matrix_bytes(self.direction))
+
+    def extend_sequence_a(self, symbols):
+        """
+        Appends symbols to sequenceA, filling only the new rows once aligned
+        Rows never depend on the symbols below them, so the matrices, max_value, max_indices
+            and alignments are the same as aligning the longer sequence from scratch
+        """
+        if self.score_only or self.x_drop is not None or self.checkpoint is not None:
+            raise ValueError("Only matrices kept in memory by a full fill can be extended")
+        first_row = len(self.sequenceA) + 1
+        self.sequenceA += symbols
+        self.codes_a += self.substitution_matrix.encode(symbols, remember=False)
+        with phase(self.stats, "allocate"):
+            self.optimal.extend([0 for x in range(len(self.sequenceB)+1)]
+                                for x in range(len(symbols)))
+            self.direction.add_rows(len(symbols))
+        if not self.aligned:
+            return
+        # The alignment start is found again by get_relative_position
+        self.relative_position = NotImplemented
+        self.start_indices = None
+
+        with phase(self.stats, "align"):
+            for i in range(first_row, len(self.sequenceA)+1):
+                self.optimal[i][0] = 0
+                self.direction[i][0] = self.UP
+            self.fill_rows(first_row)
+        if self.stats is not None:
+            self.stats.count("cells", len(symbols) * len(self.sequenceB))
+
+    def align_without_x_drop(self):
+        """
+        Fills again as align would without x_drop, replacing an inexact X-drop result
+        """
+        self.max_value = 0
+        self.max_indices = [0, 0]
+        if self.score_only:
+            self.align_score_only()
+        else:
+            self.align_full()
+        self.cells_computed += len(self.sequenceA) * len(self.sequenceB)
+
+    def align_full(self):
+        # Rows before first_row were filled by an earlier, interrupted align()
+        first_row = 1 if self.checkpoint is None else self.checkpoint.first_row
+
         # Compute insertions and deletions for 1st row and 1st column
         # Set the values of row 0 and column 0
-        self.optimal[0][0] = 0
-        self.direction[0][0] = self.DIAGONAL
+        if first_row == 1:
+            self.optimal[0][0] = 0
+            self.direction[0][0] = self.DIAGONAL
 
-        for i in range(1, len(self.sequenceA)+1):
-            self.optimal[i][0] = 0
-            self.direction[i][0] = self.UP
+            for i in range(1, len(self.sequenceA)+1):
+                self.optimal[i][0] = 0
+                self.direction[i][0] = self.UP
+
+            for i in range(1, len(self.sequenceB)+1):
+                self.optimal[0][i] = 0
+                self.direction[0][i] = self.LEFT
 
-        for i in range(1, len(self.sequenceB)+1):
-            self.optimal[0][i] = 0
-            self.direction[0][i] = self.LEFT
+        self.fill_rows(first_row)
 
+    def fill_rows(self, first_row):
+        """
+        Computes the cells of rows first_row onwards, the rows above already filled
+        """
         # Compute the rest of the cells
-        for i in range(1, len(self.sequenceA)+1):
+        for i in range(first_row, len(self.sequenceA)+1):
+            # Scores of pairing symbol i with each symbol of sequenceB
+            scores = self.substitution_matrix.scores[self.codes_a[i-1]]
+            # Taken once per row, indexing the matrix for each cell builds a new row view
+            direction_row = self.direction[i]
             for j in range(1, len(self.sequenceB)+1):
 
-                if self.sequenceA[i-1] == self.sequenceB[j-1]:
-                    score_diagonal = self.optimal[i - 1][j - 1] + self.match_cost  # If Symbols Match
-                else:
-                    score_diagonal = self.optimal[i - 1][j - 1] + self.substitution  # Otherwise Substitute
+                score_diagonal = self.optimal[i - 1][j - 1] + scores[self.codes_b[j-1]]  # Match or Substitute
 
                 score_left = self.optimal[i][j - 1] + self.insert
                 score_up = self.optimal[i - 1][j] + self.delete
@@ -91,82 +255,419 @@ class SmithWaterman:
                                          score_diagonal,  # Score of going Diagonal
                                          score_left,  # Score of going Left
                                          score_up)  # Score of going Up
-                self.direction[i][j] = 0
+                direction = 0
                 if self.optimal[i][j] == score_left:
-                    self.direction[i][j] += self.LEFT
+                    direction += self.LEFT
                 if self.optimal[i][j] == score_diagonal:
-                    self.direction[i][j] += self.DIAGONAL
+                    direction += self.DIAGONAL
                 if self.optimal[i][j] == score_up:
-                    self.direction[i][j] += self.UP
+                    direction += self.UP
+                direction_row[j] = direction
 
                 if self.optimal[i][j] > self.max_value:
                     self.max_value = self.optimal[i][j]
                     self.max_indices = [i, j]
                 # end of align
+            if self.checkpoint is not None:
+                self.checkpoint.completed_row(i, {"max_value": self.max_value,
+                                                  "max_indices": self.max_indices})
 
-    def print_matrices(self):
+    def print_matrices(self, output_file=None, window=matrix_export.DEFAULT_WINDOW, around="end"):
         """
         Prints out Optimal and Direction Matrices
+        Matrices larger than window are cut down to the cells around the best cell,
+            or around the first traceback path with around="path"
+        """
+        if self.optimal is None:
+            print("\nNo matrices are kept in score only mode", file=output_file)
+            return
+        matrix_export.write_matrices(self, output_file, window, around)
+
+    def is_alignment_start(self, d, a):
+        return self.optimal[d][a] == 0
+
+    def recurse_tree(self, d, a, tail_top, tail_bottom):
+        """
+        Follows Arrows Through Direction Matrix From End to Origin
+        The relative position comes from the last path a full walk would reach,
+            which is found directly by always taking the last arrow of a cell
+        """
+        start_d, start_a = alignment_paths.last_alignment_start(self, d, a, self.is_alignment_start, self.stats)
+        self.relative_position = start_d - start_a
+
+    def align_score_only(self):
         """
+        Finds max_value and max_indices like align, keeping only the previous and current rows
+        """
+        codes_b = self.codes_b
+        previous = [0] * (len(self.sequenceB)+1)
+        for i in range(1, len(self.sequenceA)+1):
+            scores = self.substitution_matrix.scores[self.codes_a[i-1]]
+            current = [0] * (len(self.sequenceB)+1)
+            for j in range(1, len(self.sequenceB)+1):
+                score_diagonal = previous[j - 1] + scores[codes_b[j-1]]
+                current[j] = max(0,
+                                 score_diagonal,
+                                 current[j - 1] + self.insert,
+                                 previous[j] + self.delete)
+                if current[j] > self.max_value:
+                    self.max_value = current[j]
+                    self.max_indices = [i, j]
+            previous = current
 
+    def align_x_drop(self):
         """
-        Print Optimal Matrix
+        Finds max_value and max_indices like align, only computing cells that can
+            still lead to a good alignment
+
+        Each row keeps just its live cells, those scoring above 0 and no more than
+            x_drop below the best score so far. A row computes the cells its live
+            cells extend into, below, diagonally and to the right, plus the cells
+            where a new alignment starts on a positively scoring pair while the best
+            pair score is still within x_drop of the best. Once that stops being true and a
+            row has no live cells left, the rest of sequenceA is skipped
+        Cells not computed read as 0, as they would at the start of an alignment
+        A cell dropped with score s at (i, j) could still reach s plus the best
+            diagonal score for each remaining row and column, the result is exact
+            when no dropped cell could reach above max_value, or tie it at an
+            earlier cell
         """
-        print("\n", "_"*7, "Optimal Matrix", "_"*7)
-        print("\t\t" + "\t".join(list(self.sequenceB)))
-        for i in range(0, len(self.sequenceA)+1):
+        codes_a = self.codes_a
+        codes_b = self.codes_b
+        substitution_scores = self.substitution_matrix.scores
+        best_pair = self.substitution_matrix.best_score()
+        rows = len(codes_a)
+        columns = len(codes_b)
+        keep_matrices = self.optimal is not None
+        if keep_matrices:
+            self.direction[0][0] = self.DIAGONAL
+            for i in range(1, rows+1):
+                self.direction[i][0] = self.UP
+            for j in range(1, columns+1):
+                self.direction[0][j] = self.LEFT
 
-            if i >= 1:
-                print(self.sequenceA[i-1] + '\t', end="")
+        # Columns of sequenceB scoring above 0 against each symbol, where new alignments can start
+        start_columns = self.substitution_matrix.positive_columns(codes_b)
+
+        # Dropped cells that could still reach the best score when they were dropped
+        dropped = []
+        starts_dropped_from = None
+        cells = 0
+
+        previous = {}
+        for i in range(1, rows+1):
+            starts_open = best_pair >= self.max_value - self.x_drop
+            if not starts_open and starts_dropped_from is None:
+                starts_dropped_from = i
+            if not previous and not starts_open:
+                break
+
+            candidates = set(previous)
+            candidates.update(j + 1 for j in previous if j < columns)
+            if starts_open:
+                candidates.update(start_columns[codes_a[i-1]])
+            candidates = sorted(candidates)
+
+            scores = substitution_scores[codes_a[i-1]]
+            current = {}
+            if keep_matrices:
+                direction_row = self.direction[i]
+            index = 0
+            left_column = None
+            while True:
+                # The cell right of a live cell is computed even when no other cell leads to it
+                if left_column is not None and (index == len(candidates) or candidates[index] > left_column):
+                    j = left_column
+                elif index < len(candidates):
+                    j = candidates[index]
+                    index += 1
+                else:
+                    break
+                left_column = None
+                cells += 1
+
+                score_diagonal = previous.get(j - 1, 0) + scores[codes_b[j-1]]
+                score_left = current.get(j - 1, 0) + self.insert
+                score_up = previous.get(j, 0) + self.delete
+                score = max(0, score_diagonal, score_left, score_up)
+
+                if keep_matrices:
+                    self.optimal[i][j] = score
+                    direction = 0
+                    if score == score_left:
+                        direction += self.LEFT
+                    if score == score_diagonal:
+                        direction += self.DIAGONAL
+                    if score == score_up:
+                        direction += self.UP
+                    direction_row[j] = direction
+
+                if score > self.max_value:
+                    self.max_value = score
+                    self.max_indices = [i, j]
+
+                if score <= 0:
+                    continue
+                if score < self.max_value - self.x_drop:
+                    dropped.append((i, j, score))
+                    continue
+                current[j] = score
+                if j < columns:
+                    left_column = j + 1
+            previous = current
+
+        if starts_dropped_from is not None:
+            # The first column of the first row without new starts reaches furthest
+            dropped.append((starts_dropped_from, 1, best_pair))
+        self.cells_computed = cells
+        self.exact = not any(self.could_change_result(i, j, score) for i, j, score in dropped)
+
+    def could_change_result(self, i, j, score):
+        """
+        True when a path through cell (i, j) scoring score could beat max_value,
+            or tie it at a cell before max_indices in row-major order
+        """
+        if self.insert > 0 or self.delete > 0:
+            return True
+        best_diagonal = self.substitution_matrix.best_score()
+        steps = min(len(self.sequenceA) - i, len(self.sequenceB) - j)
+        if best_diagonal <= 0:
+            return score >= self.max_value
+        reach = score + best_diagonal * steps
+        if reach != self.max_value:
+            return reach > self.max_value
+        # Tying needs every remaining diagonal step, ending steps rows and columns further on
+        return [i + steps, j + steps] < self.max_indices
+
+    def find_alignment_start(self):
+        """
+        Recovers the start of the best local alignment without a Direction Matrix,
+            the same start recurse_tree reaches, see alignment_start
+        """
+        self.start_indices = alignment_start(self.codes_a, self.codes_b, self.max_value, self.max_indices,
+                                             self.insert, self.delete, self.substitution_matrix, self.stats)
+        self.relative_position = self.start_indices[0] - self.start_indices[1]
+
+    def get_relative_position(self):
+        with phase(self.stats, "traceback"):
+            if self.score_only:
+                self.find_alignment_start()
             else:
-                print('\t', end="")
-            for j in range(0, len(self.sequenceB)+1):
-                print(str(self.optimal[i][j]) + '\t', end=""),
-            print("")
+                self.recurse_tree(self.max_indices[0], self.max_indices[1], '', '')
+
+
+class TemplateAlignment:
+    """
+    Result of aligning one read against a TemplateAligner's template
+    Carries the same fields main() reads from a SmithWaterman object
+    """
+    def __init__(self, sequence_b, max_value, max_indices, relative_position):
+        self.sequenceB = sequence_b
+        self.max_value = max_value
+        self.max_indices = max_indices
+        self.relative_position = relative_position
+
+
+class TemplateAligner:
+    """
+    Local aligner built once for a template and reused for every read
+
+    The template is encoded once into a query profile, one row of diagonal scores
+        per symbol, so filling a column of the Optimal Matrix for a read symbol is a
+        few NumPy operations over the whole template. The up score chains down the
+        column and is resolved with a prefix-max scan, or step by step for float scores
+    Only the current column is kept, the start of the alignment is then found by
+        filling again, two rows at a time, the few template rows the alignment can span
+    """
+    def __init__(self, template,
+                 insertion_cost=-1,
+                 deletion_cost=-1,
+                 substitution_cost=-3,
+                 match_cost=1,
+                 substitution_matrix=None):
+        if np is None:
+            raise ImportError("TemplateAligner requires NumPy to be installed")
+
+        self.template = template
+        self.insert = insertion_cost
+        self.delete = deletion_cost
+        self.substitution = substitution_cost
+        self.match_cost = match_cost
+
+        if substitution_matrix is None:
+            substitution_matrix = identity_matrix(match_cost, substitution_cost)
+        self.substitution_matrix = substitution_matrix
+        self.template_codes = np.frombuffer(substitution_matrix.encode(template), dtype=np.uint8)
+
+        # Scores are kept as 64 bit integers, or as floats when a gap cost or pair score is one
+        if (isinstance(insertion_cost, float) or isinstance(deletion_cost, float) or
+                substitution_matrix.has_float_scores()):
+            self.dtype = np.dtype(np.float64)
+        else:
+            self.dtype = np.dtype(np.int64)
+        self.build_profile()
+
+        # Cost of reaching row i purely by deletions, used to turn the up chain into a running maximum
+        self.delete_ramp = np.arange(len(template)+1, dtype=self.dtype) * deletion_cost
 
+    def build_profile(self):
         """
-        Print Direction Matrix
+        Row code of the profile holds the scores of symbol code against each template symbol
         """
-        print("\n", "_"*7, "Direction Matrix", "_"*7)
-        print("\t\t" + "\t".join(list(self.sequenceB)))
-        for i in range(0, len(self.sequenceA)+1):
-            if i >= 1:
-                print(self.sequenceA[i-1] + '\t', end=""),
+        self.profile = self.substitution_matrix.table().astype(self.dtype)[:, self.template_codes]
+
+    def align(self, read):
+        best_value = 0
+        best_indices = [0, 0]
+
+        read_codes = self.substitution_matrix.encode(read, remember=False)
+        if len(self.substitution_matrix.alphabet) > len(self.profile):
+            # The read brought new symbols into an identity matrix
+            self.build_profile()
+
+        column = np.zeros(len(self.template)+1, dtype=self.dtype)
+        scores = np.empty(len(self.template)+1, dtype=self.dtype)
+        for j, code in enumerate(read_codes, 1):
+            profile = self.profile[code]
+            scores[0] = 0
+            np.maximum(column[:-1] + profile, column[1:] + self.insert, out=scores[1:])
+            np.maximum(scores, 0, out=scores)
+            if self.dtype.kind == "i":
+                scores -= self.delete_ramp
+                np.maximum.accumulate(scores, out=scores)
+                scores += self.delete_ramp
             else:
-                print('\t', end=""),
-            for j in range(0, len(self.sequenceB)+1):
-                print(str(self.direction[i][j]) + '\t', end=""),
-            print("")
+                # Float sums depend on their order, so the up chain is added one step at a
+                # time, as align adds it, until no cell gains from the cell above
+                while True:
+                    up = scores[:-1] + self.delete
+                    if not (up > scores[1:]).any():
+                        break
+                    np.maximum(scores[1:], up, out=scores[1:])
+            column, scores = scores, column
 
-    def recurse_tree(self, d, a, tail_top, tail_bottom):
+            # Keep the first cell in row-major order holding the maximum, as align does
+            i = int(column.argmax())
+            value = column[i].item()
+            if value > best_value or (value == best_value and value > 0 and i < best_indices[0]):
+                best_value = value
+                best_indices = [i, j]
+
+        relative_position = self.relative_position(read, best_value, best_indices)
+        return TemplateAlignment(read, best_value, best_indices, relative_position)
+
+    def relative_position(self, read, max_value, max_indices):
         """
-        Follows Arrows Through Direction Matrix From End to Origin
-        If a cell has multiple arrows, paths diverge and alignment is
-            found for each possible path
+        Relative position of the read's best alignment, traced back by alignment_start
         """
+        start_i, start_j = alignment_start(self.substitution_matrix.encode(self.template),
+                                           self.substitution_matrix.encode(read, remember=False),
+                                           max_value, max_indices, self.insert, self.delete,
+                                           self.substitution_matrix)
+        return start_i - start_j
 
-        if self.optimal[d][a] == 0:
-            self.relative_position = d - a
 
-        else:
-            tc = ''
-            if d >= 0:
-                tc = self.sequenceA[d-1]
-            bc = ''
-            if a >= 0:
-                bc = self.sequenceB[a-1]
+def alignment_start(codes_a, codes_b, max_value, max_indices, insertion_cost, deletion_cost,
+                    substitution_matrix, stats=None):
+    """
+    Returns the [i, j] start last_alignment_start reaches from the end of a local
+        alignment scoring max_value and ending at max_indices, keeping two rows
+    Only the rows of codes_a such an alignment can span are filled again, each cell
+        carrying the start its traceback reaches by taking the last arrow, UP before
+        DIAGONAL before LEFT, as a cell scoring 0 is its own start
+    Every such alignment starts inside the window, so the arrows followed and the
+        start reached are the same as in a fill of the whole of codes_a
+    """
+    end_i, end_j = max_indices
+    if max_value == 0:
+        return [end_i, end_j]
 
-            if (self.direction[d][a] & self.LEFT) == self.LEFT:  # If Left Arrow
-                self.recurse_tree(d, a - 1, '-' + tail_top, bc + tail_bottom)
+    best_diagonal = substitution_matrix.best_score()
+    if deletion_cost < 0:
+        deletions = (end_j * best_diagonal - max_value) // -deletion_cost
+        # One row more, as rounding can take a deletion off float costs
+        first_row = max(0, int(end_i - end_j - deletions) - 1)
+    else:
+        first_row = 0
 
-            if (self.direction[d][a] & self.DIAGONAL) == self.DIAGONAL:  # If Diagonal Arrow
-                self.recurse_tree(d - 1, a - 1, tc + tail_top, bc + tail_bottom)
+    previous = [0] * (end_j + 1)
+    previous_starts = [(first_row, j) for j in range(end_j + 1)]
+    for i in range(first_row + 1, end_i + 1):
+        scores = substitution_matrix.scores[codes_a[i-1]]
+        current = [0] * (end_j + 1)
+        starts = [(i, 0)] * (end_j + 1)
+        for j in range(1, end_j + 1):
+            score_diagonal = previous[j - 1] + scores[codes_b[j-1]]
+            score_left = current[j - 1] + insertion_cost
+            score_up = previous[j] + deletion_cost
+            score = max(0, score_diagonal, score_left, score_up)
+            current[j] = score
+            if score == 0:
+                starts[j] = (i, j)
+            elif score == score_up:
+                starts[j] = previous_starts[j]
+            elif score == score_diagonal:
+                starts[j] = previous_starts[j - 1]
+            else:
+                starts[j] = starts[j - 1]
+        if stats is not None:
+            stats.count("traceback_nodes", end_j)
+        previous = current
+        previous_starts = starts
+    return list(previous_starts[end_j])
 
-            if (self.direction[d][a] & self.UP) == self.UP:  # If Up Arrow
-                self.recurse_tree(d - 1, a, tc + tail_top, '-' + tail_bottom)
 
-    def get_relative_position(self):
-        self.recurse_tree(self.max_indices[0], self.max_indices[1], '', '')
+class TemplateIndex:
+    """
+    k-mer index over a template, used to place reads without a full local alignment
+
+    Each k-mer shared by a read and the template votes for the diagonal
+        (template position - read position) they sit on. SmithWaterman then only
+        runs on the template window around the best voted diagonal, widened by band
+        on each side to allow for gaps. Reads sharing no k-mer with the template fall
+        back to aligning against the whole template
+    k-mers occurring more than max_occurrences times are not indexed, as repeats
+        vote for every copy and add work without placing the read
+    """
+    def __init__(self, template, k=11, band=8, max_occurrences=64, stats=None, cache=None,
+                 substitution_matrix=None):
+        self.template = template
+        self.k = k
+        self.band = band
+        self.stats = stats
+        self.cache = cache
+        self.substitution_matrix = substitution_matrix
+
+        self.positions = {}
+        for i in range(len(template) - k + 1):
+            self.positions.setdefault(template[i:i+k], []).append(i)
+        for kmer in [kmer for kmer, positions in self.positions.items() if len(positions) > max_occurrences]:
+            del self.positions[kmer]
+
+    def candidate_diagonals(self, read):
+        """
+        Returns the diagonals seeded by the read, most votes first, then leftmost
+        """
+        votes = {}
+        for j in range(len(read) - self.k + 1):
+            for i in self.positions.get(read[j:j+self.k], ()):
+                votes[i - j] = votes.get(i - j, 0) + 1
+        return sorted(votes, key=lambda diagonal: (-votes[diagonal], diagonal))
+
+    def align(self, read):
+        diagonals = self.candidate_diagonals(read)
+        if not diagonals:
+            return local_align(self.template, read, stats=self.stats, cache=self.cache,
+                               substitution_matrix=self.substitution_matrix)
+
+        first_row = max(0, diagonals[0] - self.band)
+        last_row = min(len(self.template), diagonals[0] + len(read) + self.band)
+        smith_waterman = local_align(self.template[first_row:last_row], read, stats=self.stats, cache=self.cache,
+                                     substitution_matrix=self.substitution_matrix)
+        return TemplateAlignment(read,
+                                 smith_waterman.max_value,
+                                 [smith_waterman.max_indices[0] + first_row, smith_waterman.max_indices[1]],
+                                 smith_waterman.relative_position + first_row)
 
 
 def get_input_directory():
@@ -174,10 +675,8 @@ def get_input_directory():
     return os.path.join(directory_path, "inputs")
 
 
-def read_sequences():
-    try:
-        file_name = sys.argv[1]
-    except IndexError:
+def read_sequences(file_name=None):
+    if file_name is None:
         print("Available Input Files:")
         input_directory = get_input_directory()
         input_file_names = os.listdir(input_directory)
@@ -198,57 +697,415 @@ def read_sequences():
             except IndexError:
                 file_name = None
 
-    input_file = open(file_name)
-    sequences = input_file.read().split("\n")
-    sequences = [sequence for sequence in sequences if len(sequence.rstrip()) > 0]
-    template = sequences[0]
-    shorter_sequences = sequences[1:]
-    return template, shorter_sequences
+    # The reads are returned as a generator, so they are only read as they are aligned
+    sequences = iterate_sequences(file_name)
+    template = next(sequences)
+    return template, sequences
 
 
-def local_align(sequence1, sequence2):
+def local_align(sequence1, sequence2, score_only=False, stats=None, cache=None, x_drop=None,
+                substitution_matrix=None):
+    """
+    Aligns sequence2 locally against sequence1 and finds its relative_position
+    x_drop fills the matrices in X-drop mode, see SmithWaterman.align_x_drop, again in full when inexact
+    substitution_matrix scores the symbol pairs instead of the match and substitution costs
+    With an AlignmentCache only the score, end cell and relative_position are kept,
+        and a TemplateAlignment holding them is returned instead of the aligner
+    """
+    if cache is not None:
+        # Score only and full fills can settle on different co-optimal starts, so they are kept apart
+        algorithm = "local_align:score_only" if score_only else "local_align"
+        if x_drop is not None:
+            algorithm += ":x_drop=%r" % (x_drop,)
+        if substitution_matrix is not None:
+            algorithm += " " + substitution_matrix.name
+        key = cache_key(algorithm, sequence1, sequence2, -1, -1, -3, 1)
+        result = cache.get(key)
+        if result is None:
+            smith_waterman = local_align(sequence1, sequence2, score_only, stats, x_drop=x_drop,
+                                         substitution_matrix=substitution_matrix)
+            result = {"score": smith_waterman.max_value,
+                      "end": list(smith_waterman.max_indices),
+                      "relative_position": smith_waterman.relative_position}
+            cache.put(key, result)
+        return TemplateAlignment(sequence2, result["score"], result["end"], result["relative_position"])
+
     smith_waterman = SmithWaterman(sequence_a=sequence1,
                                    sequence_b=sequence2,
                                    insertion_cost=-1,
                                    deletion_cost=-1,
                                    substitution_cost=-3,
-                                   match_cost=1)
+                                   match_cost=1,
+                                   score_only=score_only,
+                                   stats=stats,
+                                   x_drop=x_drop,
+                                   substitution_matrix=substitution_matrix)
     smith_waterman.align()
     smith_waterman.get_relative_position()
     return smith_waterman
 
 
-def merge_strings(string_list):
-    while len(string_list) > 1:
-        x = string_list[0]
-        y = string_list[1]
-        z = 0
-        for i in range(len(x)+1):
-            if x[i:] == y[:len(x)-i]:
-                z = x[:i] + y
+# Reads align_reads_cached looks up in the cache before sending the missing ones to the pool
+CACHED_BLOCK_SIZE = 4096
+
+
+# Per process state of an align_reads_parallel worker, set once by init_worker
+worker_template = None
+worker_aligner = None
+worker_x_drop = None
+worker_matrix = None
+
+
+def init_worker(template, seed_length=None, x_drop=None, substitution_matrix=None):
+    global worker_template, worker_aligner, worker_x_drop, worker_matrix
+    worker_template = template
+    worker_x_drop = x_drop
+    worker_matrix = substitution_matrix
+    if seed_length:
+        worker_aligner = TemplateIndex(template, k=seed_length, substitution_matrix=substitution_matrix)
+    elif np is not None and x_drop is None:
+        worker_aligner = TemplateAligner(template, substitution_matrix=substitution_matrix)
+
+
+def align_read(read):
+    """
+    Aligns one read in a worker, returning (relative_position, score, read)
+    """
+    if worker_aligner is not None:
+        result = worker_aligner.align(read)
+    else:
+        result = local_align(worker_template, read, score_only=worker_x_drop is not None, x_drop=worker_x_drop,
+                             substitution_matrix=worker_matrix)
+    return result.relative_position, result.max_value, read
+
+
+def reads_pool(template, workers=None, seed_length=None, x_drop=None, substitution_matrix=None):
+    return multiprocessing.Pool(workers, initializer=init_worker,
+                                initargs=(template, seed_length, x_drop, substitution_matrix))
+
+
+def align_reads_parallel(template, reads, workers=None, chunk_size=16, seed_length=None, x_drop=None,
+                         substitution_matrix=None):
+    """
+    Lazily aligns reads against template on a pool of worker processes
+    The template is sent to each worker once when it starts, and only
+        (relative_position, score, read) comes back for each read, in read order
+    With seed_length each worker places reads through its own TemplateIndex,
+        otherwise x_drop has each worker align in X-drop mode
+    """
+    with reads_pool(template, workers, seed_length, x_drop, substitution_matrix) as pool:
+        for result in pool.imap(align_read, reads, chunksize=chunk_size):
+            yield result
+
+
+def align_reads_cached(template, reads, cache, workers=None, chunk_size=16, seed_length=None, x_drop=None,
+                       substitution_matrix=None, block_size=CACHED_BLOCK_SIZE):
+    """
+    align_reads_parallel, looking each read up in cache first
+    Reads are taken block_size at a time, only those missing from the cache go
+        to the workers, and a read repeated in the input is aligned once
+    The pool is only started once a read is missing
+    """
+    if seed_length:
+        algorithm = "align_read:%d" % seed_length
+    elif x_drop is not None:
+        algorithm = "align_read:x_drop=%r" % (x_drop,)
+    else:
+        algorithm = "align_read"
+    if substitution_matrix is not None:
+        algorithm += " " + substitution_matrix.name
+
+    pool = None
+    try:
+        reads = iter(reads)
+        while True:
+            block = list(itertools.islice(reads, block_size))
+            if not block:
                 break
-        string_list = [z] + string_list[2:]
-    return string_list[0]
+            keys = []
+            found = {}
+            missing = collections.OrderedDict()
+            for read in block:
+                key = cache_key(algorithm, template, read, -1, -1, -3, 1)
+                keys.append(key)
+                if key in found or key in missing:
+                    continue
+                result = cache.get(key)
+                if result is None:
+                    missing[key] = read
+                else:
+                    found[key] = result
+
+            if missing:
+                if pool is None:
+                    pool = reads_pool(template, workers, seed_length, x_drop, substitution_matrix)
+                results = pool.imap(align_read, missing.values(), chunksize=chunk_size)
+                for key, (relative_position, score, read) in zip(missing, results):
+                    found[key] = [relative_position, score]
+                    cache.put(key, found[key])
+
+            for key, read in zip(keys, block):
+                yield found[key][0], found[key][1], read
+    finally:
+        if pool is not None:
+            pool.terminate()
+
+
+def prefix_function(string):
+    """
+    KMP failure table, entry i is the length of the longest proper prefix of
+        string[:i+1] that is also a suffix of it
+    """
+    failure = [0] * len(string)
+    k = 0
+    for i in range(1, len(string)):
+        while k > 0 and string[i] != string[k]:
+            k = failure[k - 1]
+        if string[i] == string[k]:
+            k += 1
+        failure[i] = k
+    return failure
+
+
+def overlap_length(x, y):
+    """
+    Length of the longest suffix of x that is a prefix of y, in O(len(x) + len(y))
+    """
+    if len(y) == 0:
+        return 0
+    failure = prefix_function(y)
+    k = 0
+    for symbol in x:
+        while k > 0 and (k == len(y) or y[k] != symbol):
+            k = failure[k - 1]
+        if y[k] == symbol:
+            k += 1
+    return k
+
+
+class ContigBuilder:
+    """
+    Grows a contig by overlapping each new read onto its end
+    A read can only overlap the last len(read) symbols, so only those are
+        scanned, and the contig is kept as a list of appended pieces rather
+        than rebuilt as a new string for every read
+    """
+    def __init__(self):
+        self.pieces = []
+        self.length = 0
+
+    def tail(self, length):
+        """
+        Returns the last length symbols of the contig
+        """
+        tail = []
+        collected = 0
+        for piece in reversed(self.pieces):
+            if collected >= length:
+                break
+            tail.append(piece)
+            collected += len(piece)
+        return "".join(reversed(tail))[-length:] if length > 0 else ""
+
+    def add(self, read):
+        overlap = overlap_length(self.tail(len(read)), read)
+        if overlap < len(read):
+            self.pieces.append(read[overlap:])
+            self.length += len(read) - overlap
+
+    def value(self):
+        return "".join(self.pieces)
 
 
-def write_sequence(output_string):
-    out_file = open('output\output.txt', 'w')
-    out_file.write(output_string)
-    out_file.close()
+class ContigWriter(ContigBuilder):
+    """
+    ContigBuilder writing the contig to output_files as it grows
+    A read of up to keep symbols can only overlap the last keep symbols of the
+        contig, so once more than twice that is held everything before them is
+        written out and dropped
+    keep must be at least the length of the longest read, as symbols written
+        out cannot be overlapped again
+    """
+    def __init__(self, output_files, keep):
+        ContigBuilder.__init__(self)
+        self.output_files = output_files
+        self.keep = keep
+        # Symbols held in pieces, the rest of the contig has been written
+        self.held = 0
+
+    def add(self, read):
+        if len(read) > self.keep:
+            raise ValueError("A read of %d symbols is longer than the %d symbols the contig keeps" %
+                             (len(read), self.keep))
+        length = self.length
+        ContigBuilder.add(self, read)
+        self.held += self.length - length
+        if self.held > 2 * self.keep:
+            self.flush(self.keep)
+
+    def flush(self, keep=0):
+        """
+        Writes out all but the last keep symbols held
+        """
+        held = "".join(self.pieces)
+        split = max(0, len(held) - keep)
+        for output_file in self.output_files:
+            output_file.write(held[:split])
+        self.pieces = [held[split:]] if keep else []
+        self.held = keep
+
+    def close(self):
+        self.flush()
+
+
+def place_reads(template, reads, workers=None, chunk_size=16, seed_length=None, stats=None, cache=None,
+                x_drop=None, substitution_matrix=None):
+    """
+    Yields a ReadPlacement for each read, in read order
+    Each alignment, matrices and all, is dropped as soon as its placement is taken
+    """
+    if workers:
+        if cache is not None:
+            results = align_reads_cached(template, reads, cache,
+                                         workers=workers,
+                                         chunk_size=chunk_size,
+                                         seed_length=seed_length,
+                                         x_drop=x_drop,
+                                         substitution_matrix=substitution_matrix)
+        else:
+            results = align_reads_parallel(template, reads,
+                                           workers=workers,
+                                           chunk_size=chunk_size,
+                                           seed_length=seed_length,
+                                           x_drop=x_drop,
+                                           substitution_matrix=substitution_matrix)
+        for relative_position, score, read in results:
+            yield ReadPlacement(read, relative_position, score)
+        return
+
+    if seed_length:
+        template_index = TemplateIndex(template, k=seed_length, stats=stats, cache=cache,
+                                       substitution_matrix=substitution_matrix)
+    for sequence in reads:
+        if seed_length:
+            sw = template_index.align(sequence)
+        else:
+            sw = local_align(template, sequence, score_only=x_drop is not None, stats=stats, cache=cache,
+                             x_drop=x_drop, substitution_matrix=substitution_matrix)
+        yield ReadPlacement(sw.sequenceB, sw.relative_position, sw.max_value)
+
+
+def merge_strings(string_list):
+    contig = ContigBuilder()
+    for string in string_list:
+        contig.add(string)
+    return contig.value()
+
+
+# Where main saves the assembled sequence
+OUTPUT_FILE = 'output\\output.txt'
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Assembles reads by their local alignment to a template")
+    parser.add_argument("input_file", nargs="?", default=None,
+                        help="template on the first line, then one read per line")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="align reads on this many processes instead of serially")
+    parser.add_argument("--chunk-size", type=int, default=16,
+                        help="reads sent to a worker at a time")
+    parser.add_argument("--seed-length", type=int, default=None,
+                        help="place reads with a k-mer index of this k instead of full alignments")
+    parser.add_argument("--stats", nargs="?", const="-", default=None, metavar="JSON_FILE",
+                        help="print phase timings and work counts, or write them to JSON_FILE")
+    parser.add_argument("--x-drop", type=int, default=None,
+                        help="stop extending alignments scoring this far below the best, "
+                             "reads it cannot place exactly are aligned again in full")
+    parser.add_argument("--matrix", default=None, metavar="NAME",
+                        help="score symbol pairs with a substitution matrix from the matrices folder, "
+                             "such as DNA or BLOSUM62, or in the file NAME")
+    parser.add_argument("--cache", metavar="CACHE_FILE", default=None,
+                        help="SQLite file keeping read alignments between runs")
+    parser.add_argument("--cache-size", type=int, default=None,
+                        help="alignments kept in memory, caching in memory only when --cache is not given")
+    parser.add_argument("--memory-budget", type=float, default=DEFAULT_MEMORY_BUDGET / (1024.0 * 1024.0),
+                        metavar="MB", help="megabytes of read placements sorted in memory before spilling to disk")
+    return parser.parse_args()
+
+
+def assemble(template, reads, workers=None, chunk_size=16, seed_length=None, stats=None, cache=None,
+             x_drop=None, substitution_matrix=None, memory_budget=DEFAULT_MEMORY_BUDGET):
+    """
+    Orders the reads by where they align on the template and merges them into one sequence
+    See assemble_to for the arguments
+    """
+    output = io.StringIO()
+    assemble_to([output], template, reads, workers, chunk_size, seed_length, stats, cache,
+                x_drop, substitution_matrix, memory_budget)
+    return output.getvalue()
+
+
+def assemble_to(output_files, template, reads, workers=None, chunk_size=16, seed_length=None, stats=None,
+                cache=None, x_drop=None, substitution_matrix=None, memory_budget=DEFAULT_MEMORY_BUDGET):
+    """
+    Orders the reads by where they align on the template and writes the merged
+        sequence to each of output_files as it grows
+    Only a ReadPlacement of each read is kept, placements past memory_budget
+        bytes are sorted on disk in runs
+    With an AlignmentCache, reads aligned before are looked up instead of aligned again
+    x_drop aligns reads in X-drop mode, unless they are placed by seed_length
+    substitution_matrix scores the symbol pairs instead of the match and substitution costs
+    Returns the number of reads assembled
+    """
+    sorter = PlacementSorter(memory_budget)
+    try:
+        placements = place_reads(template, reads, workers, chunk_size, seed_length, stats, cache,
+                                 x_drop, substitution_matrix)
+        # Workers do not report their own phases, so the pool is timed as a whole
+        with phase(stats if workers else None, "parallel_align"):
+            for placement in placements:
+                sorter.add(placement)
+        if stats is not None and sorter.runs:
+            stats.count("sort_runs", len(sorter.runs))
+
+        with phase(stats, "sort"):
+            # Sorting is stable and placements are in read order, so ties keep the read order
+            ordered = sorter.sorted()
+        with phase(stats, "merge"):
+            contig = ContigWriter(output_files, sorter.longest_read)
+            for placement in ordered:
+                contig.add(placement.read)
+            contig.close()
+        return sorter.count
+    finally:
+        sorter.close()
 
 
 def main():
-    template, shorter_sequences = read_sequences()
-    sw_list = []
-    for sequence in shorter_sequences:
-        sw = local_align(template, sequence)
-        sw_list.append(sw)
-    sw_list.sort(key=lambda x: x.relative_position)
-
-    string_list = [x.sequenceB for x in sw_list]
-    output_string = merge_strings(string_list)
-    print(output_string)
-    write_sequence(output_string)
+    arguments = parse_arguments()
+    stats = AlignmentStats() if arguments.stats else None
+    cache = None
+    if arguments.cache or arguments.cache_size:
+        cache = AlignmentCache(capacity=arguments.cache_size or DEFAULT_CAPACITY,
+                               path=arguments.cache,
+                               stats=stats)
+    template, shorter_sequences = read_sequences(arguments.input_file)
+    with open(OUTPUT_FILE, 'w') as out_file:
+        assemble_to([sys.stdout, out_file], template, shorter_sequences,
+                    workers=arguments.workers,
+                    chunk_size=arguments.chunk_size,
+                    seed_length=arguments.seed_length,
+                    stats=stats,
+                    cache=cache,
+                    x_drop=arguments.x_drop,
+                    substitution_matrix=load_matrix(arguments.matrix) if arguments.matrix else None,
+                    memory_budget=int(arguments.memory_budget * 1024 * 1024))
+    print()
+    if cache is not None:
+        cache.close()
+
+    if stats is not None:
+        stats.report(arguments.stats)
 
 
 if __name__ == "__main__":
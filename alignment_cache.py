@@ -0,0 +1,193 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import collections
+
+"""
+Content addressed cache of compact alignment results
+
+Results are keyed by a hash of the algorithm, both sequences and the four edit
+costs, so a duplicate read or a rerun of the same input is looked up instead
+of refilling the matrices. Only small JSON values are stored, such as the
+score, end cell, relative_position and alignment strings, never the matrices.
+
+Two tiers:
+    memory  - least recently used dictionary of at most capacity results
+    disk    - optional SQLite file, shared between runs, evicting the least
+              recently used rows once it holds more than max_disk_bytes
+A memory miss falls through to the disk tier, and a disk hit is copied into
+memory. hits, disk_hits and misses count the lookups of each kind.
+"""
+
+DEFAULT_CAPACITY = 4096
+DEFAULT_MAX_DISK_BYTES = 256 * 1024 * 1024
+
+# Fraction of max_disk_bytes left stored after an eviction
+EVICTION_TARGET = 0.9
+
+# Disk writes are committed in groups of this many
+COMMIT_INTERVAL = 64
+
+
+def cache_key(algorithm, sequence_a, sequence_b, insertion_cost, deletion_cost, substitution_cost, match_cost):
+    """
+    Hex digest identifying one alignment problem
+    """
+    text = json.dumps([algorithm, sequence_a, sequence_b,
+                       insertion_cost, deletion_cost, substitution_cost, match_cost])
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class AlignmentCache:
+    def __init__(self, capacity=DEFAULT_CAPACITY, path=None, max_disk_bytes=DEFAULT_MAX_DISK_BYTES, stats=None):
+        self.capacity = capacity
+        self.path = path
+        self.max_disk_bytes = max_disk_bytes
+
+        # Optional AlignmentStats the lookups are also counted into
+        self.stats = stats
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        self.entries = collections.OrderedDict()
+
+        self.connection = None
+        self.pending_writes = 0
+        self.stored_bytes = 0
+        if path is not None:
+            directory = os.path.dirname(path)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+            self.connection = sqlite3.connect(path)
+            self.connection.execute("CREATE TABLE IF NOT EXISTS results ("
+                                    "key TEXT PRIMARY KEY, "
+                                    "value TEXT NOT NULL, "
+                                    "size INTEGER NOT NULL, "
+                                    "last_used REAL NOT NULL)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS results_last_used ON results (last_used)")
+            self.connection.commit()
+            # Running total of the stored sizes, so eviction does not rescan the table
+            self.stored_bytes = self.connection.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM results").fetchone()[0]
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
+        return False
+
+    def count(self, counter_name):
+        if self.stats is not None:
+            self.stats.count(counter_name)
+
+    def get(self, key):
+        """
+        Returns the result stored under key, or None
+        """
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            self.count("cache_hits")
+            return self.entries[key]
+
+        if self.connection is not None:
+            row = self.connection.execute("SELECT value FROM results WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                self.connection.execute("UPDATE results SET last_used = ? WHERE key = ?", (time.time(), key))
+                self.written()
+                result = json.loads(row[0])
+                self.remember(key, result)
+                self.hits += 1
+                self.disk_hits += 1
+                self.count("cache_hits")
+                self.count("cache_disk_hits")
+                return result
+
+        self.misses += 1
+        self.count("cache_misses")
+        return None
+
+    def put(self, key, result):
+        """
+        Stores a JSON serialisable result under key in every tier
+        """
+        self.remember(key, result)
+        if self.connection is not None:
+            value = json.dumps(result, sort_keys=True)
+            row = self.connection.execute("SELECT size FROM results WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                self.stored_bytes -= row[0]
+            self.connection.execute("INSERT OR REPLACE INTO results (key, value, size, last_used) "
+                                    "VALUES (?, ?, ?, ?)", (key, value, len(key) + len(value), time.time()))
+            self.stored_bytes += len(key) + len(value)
+            self.written()
+            self.evict_disk()
+
+    def get_or_compute(self, key, compute):
+        """
+        Returns the result under key, calling compute() and storing its result on a miss
+        """
+        result = self.get(key)
+        if result is None:
+            result = compute()
+            self.put(key, result)
+        return result
+
+    def remember(self, key, result):
+        self.entries[key] = result
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+
+    def written(self):
+        self.pending_writes += 1
+        if self.pending_writes >= COMMIT_INTERVAL:
+            self.flush()
+
+    def evict_disk(self):
+        """
+        Deletes the least recently used disk rows once more than max_disk_bytes are stored
+        Eviction goes down to EVICTION_TARGET of the limit, so it does not run on every put
+        """
+        if self.stored_bytes <= self.max_disk_bytes:
+            return
+        target = self.max_disk_bytes * EVICTION_TARGET
+        rows = self.connection.execute("SELECT key, size FROM results ORDER BY last_used")
+        evicted = []
+        while self.stored_bytes > target:
+            batch = rows.fetchmany(256)
+            if not batch:
+                break
+            for key, size in batch:
+                if self.stored_bytes <= target:
+                    break
+                evicted.append((key,))
+                self.stored_bytes -= size
+        rows.close()
+        self.connection.executemany("DELETE FROM results WHERE key = ?", evicted)
+
+    def flush(self):
+        if self.connection is not None:
+            self.connection.commit()
+        self.pending_writes = 0
+
+    def close(self):
+        if self.connection is not None:
+            self.flush()
+            self.connection.close()
+            self.connection = None
+
+    def counters(self):
+        return {"hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "entries": len(self.entries),
+                "disk_bytes": self.stored_bytes}
@@ -0,0 +1,168 @@
+import sys
+import json
+import socket
+import argparse
+import itertools
+
+from alignment_server import DEFAULT_HOST, DEFAULT_PORT, parse_address
+from sequence_reader import iterate_sequences
+
+"""
+Client of alignment_server.py
+
+Usage:
+python alignment_client.py [--address HOST:PORT | --address unix:PATH] COMMAND ...
+
+Commands:
+    load NAME FILE [--seed-length K] [--matrix NAME]
+                               load the first sequence of FILE as template NAME
+    align NAME READ...         align reads against template NAME
+    pair SEQUENCE_A SEQUENCE_B local alignment record of one pair
+    assemble FILE [--name NAME]
+                               load the first sequence of FILE as a template and
+                               assemble the rest of its sequences onto it
+    templates                  list the loaded templates
+    stats                      latency and throughput counters
+
+Example:
+python alignment_server.py --unix-socket /tmp/align.sock &
+python alignment_client.py --address unix:/tmp/align.sock assemble inputs/input.txt
+"""
+
+
+class ServerError(Exception):
+    """
+    Error response returned by the server
+    """
+
+
+class AlignmentClient:
+    """
+    Blocking connection to an alignment server, one request at a time
+    """
+    def __init__(self, address="%s:%d" % (DEFAULT_HOST, DEFAULT_PORT), timeout=None):
+        kind, location = parse_address(address)
+        if kind == "unix":
+            self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        else:
+            self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.settimeout(timeout)
+        self.socket.connect(location)
+        self.responses = self.socket.makefile("rb")
+        self.ids = itertools.count(1)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
+        return False
+
+    def close(self):
+        self.responses.close()
+        self.socket.close()
+
+    def request(self, op, **fields):
+        """
+        Sends one request and returns its response, raising ServerError for an error response
+        """
+        fields["op"] = op
+        fields["id"] = next(self.ids)
+        self.socket.sendall((json.dumps(fields) + "\n").encode("utf-8"))
+        line = self.responses.readline()
+        if not line:
+            raise ConnectionError("The server closed the connection")
+        response = json.loads(line.decode("utf-8"))
+        if "error" in response:
+            raise ServerError(response["error"])
+        del response["id"]
+        return response
+
+    def load_template(self, name, template, seed_length=None, matrix=None):
+        return self.request("load_template", name=name, template=template,
+                            seed_length=seed_length, matrix=matrix)
+
+    def align(self, template_name, reads):
+        return self.request("align", template=template_name, reads=list(reads))["results"]
+
+    def pair(self, sequence_a, sequence_b, matrix=None):
+        return self.request("pair", sequence_a=sequence_a, sequence_b=sequence_b, matrix=matrix)["result"]
+
+    def assemble(self, template_name, reads):
+        return self.request("assemble", template=template_name, reads=list(reads))["sequence"]
+
+    def templates(self):
+        return self.request("templates")["templates"]
+
+    def stats(self):
+        return self.request("stats")
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Sends requests to an alignment server")
+    parser.add_argument("--address", default="%s:%d" % (DEFAULT_HOST, DEFAULT_PORT),
+                        help="HOST:PORT or unix:PATH of the server")
+    commands = parser.add_subparsers(dest="command")
+    commands.required = True
+
+    load = commands.add_parser("load", help="load a template")
+    load.add_argument("name")
+    load.add_argument("file")
+    load.add_argument("--seed-length", type=int, default=None,
+                      help="place reads with a k-mer index of this k instead of full alignments")
+    load.add_argument("--matrix", default=None,
+                      help="substitution matrix scoring the reads against the template")
+
+    align = commands.add_parser("align", help="align reads against a loaded template")
+    align.add_argument("name")
+    align.add_argument("reads", nargs="+")
+
+    pair = commands.add_parser("pair", help="local alignment of one pair of sequences")
+    pair.add_argument("sequence_a")
+    pair.add_argument("sequence_b")
+    pair.add_argument("--matrix", default=None)
+
+    assemble = commands.add_parser("assemble", help="assemble the reads of an input file")
+    assemble.add_argument("file")
+    assemble.add_argument("--name", default=None,
+                          help="template name to load the file's template as, the file name by default")
+
+    commands.add_parser("templates", help="list the loaded templates")
+    commands.add_parser("stats", help="print the server counters")
+    return parser.parse_args()
+
+
+def main():
+    arguments = parse_arguments()
+    with AlignmentClient(arguments.address) as client:
+        try:
+            if arguments.command == "load":
+                template = next(iterate_sequences(arguments.file))
+                output = client.load_template(arguments.name, template,
+                                              seed_length=arguments.seed_length,
+                                              matrix=arguments.matrix)
+            elif arguments.command == "align":
+                output = client.align(arguments.name, arguments.reads)
+            elif arguments.command == "pair":
+                output = client.pair(arguments.sequence_a, arguments.sequence_b, matrix=arguments.matrix)
+            elif arguments.command == "assemble":
+                sequences = iterate_sequences(arguments.file)
+                name = arguments.name or arguments.file
+                client.load_template(name, next(sequences))
+                output = client.assemble(name, sequences)
+            elif arguments.command == "templates":
+                output = client.templates()
+            else:
+                output = client.stats()
+        except ServerError as error:
+            print("Server error:", error, file=sys.stderr)
+            sys.exit(1)
+
+    if isinstance(output, str):
+        print(output)
+    else:
+        print(json.dumps(output, indent=2, sort_keys=True))
+
+
+if __name__ == "__main__":
+    main()
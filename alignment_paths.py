@@ -0,0 +1,109 @@
+"""
+Traceback through a Direction Matrix without recursion
+
+Every aligner here follows the same arrows (LEFT, DIAGONAL, UP) from an end
+cell back to a start cell, where the start is (0, 0) for a global alignment
+and the first cell with an optimal score of 0 for a local one. A cell with
+several arrows starts several co-optimal alignments, so walking them all is
+exponential on repetitive sequences. These functions take the aligner and a
+start test instead, walk with an explicit stack and build each alignment
+from a list of steps rather than by prepending to strings.
+"""
+import heapq
+
+
+def arrows(aligner, d, a):
+    """
+    Yields the cells the arrows of (d, a) point to, with the top and bottom
+        symbols of that step, in the order LEFT, DIAGONAL, UP
+    """
+    direction = aligner.direction[d][a]
+    if direction & aligner.LEFT:
+        yield d, a - 1, '-', aligner.sequenceB[a-1]
+    if direction & aligner.DIAGONAL:
+        yield d - 1, a - 1, aligner.sequenceA[d-1], aligner.sequenceB[a-1]
+    if direction & aligner.UP:
+        yield d - 1, a, aligner.sequenceA[d-1], '-'
+
+
+def iterate_alignments(aligner, d, a, is_start, limit=None, stats=None):
+    """
+    Lazily yields (top, bottom, start_d, start_a) for each co-optimal alignment
+        ending at (d, a), in the same order as a recursive depth first walk
+    Stops after limit alignments when limit is given
+    Cells visited are counted as traceback_nodes when an AlignmentStats is given
+    """
+    if limit is not None and limit <= 0:
+        return
+    count = 0
+    top = []
+    bottom = []
+    # Each entry is a cell, the path length before reaching it and the step taken into it
+    stack = [(d, a, 0, None, None)]
+    while stack:
+        d, a, depth, top_symbol, bottom_symbol = stack.pop()
+        if stats is not None:
+            stats.count("traceback_nodes")
+        del top[depth:]
+        del bottom[depth:]
+        if top_symbol is not None:
+            top.append(top_symbol)
+            bottom.append(bottom_symbol)
+
+        if is_start(d, a):
+            yield ''.join(reversed(top)), ''.join(reversed(bottom)), d, a
+            count += 1
+            if limit is not None and count >= limit:
+                return
+            continue
+
+        # Pushed in reverse so the LEFT arrow is walked first
+        for step in reversed(list(arrows(aligner, d, a))):
+            stack.append((step[0], step[1], len(top), step[2], step[3]))
+
+
+def count_alignments(aligner, d, a, is_start, stats=None):
+    """
+    Counts the co-optimal alignments ending at (d, a) without enumerating them
+    The number of paths into each cell is pushed along its arrows, visiting
+        rows from the bottom up and each row from right to left, so a cell is
+        complete before any cell its arrows point to
+    """
+    total = 0
+    pending = {d: {a: 1}}
+    for row_index in range(d, -1, -1):
+        row = pending.pop(row_index, None)
+        if not row:
+            continue
+        columns = [-column for column in row]
+        heapq.heapify(columns)
+        while columns:
+            column = -heapq.heappop(columns)
+            paths = row.pop(column)
+            if stats is not None:
+                stats.count("traceback_nodes")
+            if is_start(row_index, column):
+                total += paths
+                continue
+            for next_d, next_a, top_symbol, bottom_symbol in arrows(aligner, row_index, column):
+                if next_d == row_index:
+                    if next_a not in row:
+                        row[next_a] = 0
+                        heapq.heappush(columns, -next_a)
+                    row[next_a] += paths
+                else:
+                    next_row = pending.setdefault(next_d, {})
+                    next_row[next_a] = next_row.get(next_a, 0) + paths
+    return total
+
+
+def last_alignment_start(aligner, d, a, is_start, stats=None):
+    """
+    Start cell of the last alignment a depth first walk from (d, a) would reach
+    Every branch ends at a start cell, so this always takes the last arrow
+    """
+    while not is_start(d, a):
+        if stats is not None:
+            stats.count("traceback_nodes")
+        d, a = list(arrows(aligner, d, a))[-1][:2]
+    return d, a
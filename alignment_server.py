@@ -0,0 +1,549 @@
+import os
+import sys
+import json
+import time
+import signal
+import asyncio
+import argparse
+import hashlib
+import collections
+import concurrent.futures
+
+import SmithWatermantask2
+import smithwatermantask1
+from alignment_stats import AlignmentStats
+from sequence_reader import iterate_sequences
+from substitution_matrix import load_matrix
+
+"""
+Long running local alignment server
+
+Keeps templates in memory between requests, so a pipeline making many small
+requests does not pay for a new interpreter, an input scan and the template
+setup every time. Requests and responses are JSON objects, one per line, over
+a localhost TCP socket or a Unix domain socket. Every request may carry an
+"id" that is copied into its response, responses on one connection come back
+as they complete and not necessarily in request order.
+
+Requests, by "op":
+    load_template  - {"name", "template"} or {"name", "file"}, optional
+                     "seed_length" and "matrix", keeps the template as name
+    align          - {"template", "reads"} aligns each read locally against a
+                     loaded template, returning its score, end cell and
+                     relative_position
+    pair           - {"sequence_a", "sequence_b"}, optional "matrix", the batch
+                     record of smithwatermantask1.align_pair
+    assemble       - {"template", "reads"} orders the reads by where they align
+                     and merges them, as SmithWatermantask2.assemble does
+    stats          - latency and throughput counters
+    unload_template, templates
+
+Reads and pairs from all connections are collected into micro-batches, at most
+max_batch items or whatever arrived within max_delay seconds of the first,
+and each batch is aligned on one process of a worker pool. A batch only
+carries the key of its template. A worker that does not hold the template yet
+answers without aligning and the batch is sent again with the template text,
+which the worker keeps with its TemplateAligner or TemplateIndex, so each
+worker is sent a template once rather than with every batch.
+
+Usage:
+python alignment_server.py [--port 8765 | --unix-socket PATH] [--workers N]
+                           [--max-batch 64] [--max-delay 0.005]
+
+See alignment_client.py for the client.
+"""
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8765
+
+DEFAULT_MAX_BATCH = 64
+DEFAULT_MAX_DELAY = 0.005
+
+# Requests whose latency is kept for the percentiles reported by stats
+LATENCY_WINDOW = 4096
+
+# Template aligners kept by each worker process
+WORKER_TEMPLATES = 16
+
+# Largest request line accepted
+MAX_LINE_BYTES = 64 * 1024 * 1024
+
+
+class RequestError(Exception):
+    """
+    A request that cannot be served, reported back to the client
+    """
+
+
+def parse_address(address):
+    """
+    Splits "unix:PATH", "HOST:PORT" or "PORT" into ("unix", PATH) or ("tcp", (HOST, PORT))
+    """
+    if address.startswith("unix:"):
+        return "unix", address[len("unix:"):]
+    host, separator, port = address.rpartition(":")
+    return "tcp", (host or DEFAULT_HOST, int(port))
+
+
+# Per process state of a worker, (template, aligner) by template key, least recently used first
+worker_templates = collections.OrderedDict()
+
+
+def template_key(template, seed_length, matrix_name):
+    text = json.dumps([template, seed_length, matrix_name])
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def worker_template(key, template, seed_length, matrix_name):
+    """
+    Returns (template, aligner) of a template in this worker, building the aligner
+        when template is first given, or None when template is None and the worker
+        does not hold it
+    An aligner of None means reads are aligned with local_align against the whole template
+    """
+    if key in worker_templates:
+        worker_templates.move_to_end(key)
+        return worker_templates[key]
+    if template is None:
+        return None
+
+    substitution_matrix = load_matrix(matrix_name) if matrix_name else None
+    if seed_length:
+        aligner = SmithWatermantask2.TemplateIndex(template, k=seed_length,
+                                                   substitution_matrix=substitution_matrix)
+    elif SmithWatermantask2.np is not None:
+        aligner = SmithWatermantask2.TemplateAligner(template, substitution_matrix=substitution_matrix)
+    else:
+        aligner = None
+    worker_templates[key] = (template, aligner)
+    while len(worker_templates) > WORKER_TEMPLATES:
+        worker_templates.popitem(last=False)
+    return worker_templates[key]
+
+
+def align_batch(task):
+    """
+    Aligns one micro-batch in a worker and returns a result per item
+    task is ("reads", key, seed_length, matrix_name, reads, template)
+        or ("pairs", matrix_name, pairs, None)
+    template is None unless the worker asked for it, by returning None
+    """
+    if task[0] == "pairs":
+        matrix_name, pairs = task[1:3]
+        return [smithwatermantask1.align_pair(pair, matrix_name) for pair in pairs]
+
+    key, seed_length, matrix_name, reads, template = task[1:]
+    held = worker_template(key, template, seed_length, matrix_name)
+    if held is None:
+        return None
+    template, aligner = held
+    results = []
+    for read in reads:
+        if aligner is not None:
+            alignment = aligner.align(read)
+        else:
+            substitution_matrix = load_matrix(matrix_name) if matrix_name else None
+            alignment = SmithWatermantask2.local_align(template, read, score_only=True,
+                                                       substitution_matrix=substitution_matrix)
+        results.append({"score": alignment.max_value,
+                        "end": list(alignment.max_indices),
+                        "relative_position": alignment.relative_position})
+    return results
+
+
+class Template:
+    """
+    A loaded template and the settings its reads are aligned with
+    """
+    def __init__(self, name, sequence, seed_length=None, matrix_name=None):
+        self.name = name
+        self.sequence = sequence
+        self.seed_length = seed_length
+        self.matrix_name = matrix_name
+        self.key = template_key(sequence, seed_length, matrix_name)
+
+    def describe(self):
+        return {"name": self.name,
+                "length": len(self.sequence),
+                "seed_length": self.seed_length,
+                "matrix": self.matrix_name}
+
+
+class ServerStats:
+    """
+    Request, batch and latency counters of a running server
+    """
+    def __init__(self):
+        self.started = time.time()
+        self.stats = AlignmentStats()
+        self.latencies = collections.deque(maxlen=LATENCY_WINDOW)
+
+    def count(self, counter_name, amount=1):
+        self.stats.count(counter_name, amount)
+
+    def request_done(self, op, seconds):
+        self.stats.count("requests")
+        self.stats.count("requests_" + op)
+        self.stats.add_time("latency_" + op, seconds)
+        self.latencies.append(seconds)
+
+    def to_dict(self):
+        counters = self.stats.counters
+        uptime = time.time() - self.started
+        latencies = sorted(self.latencies)
+
+        def percentile(fraction):
+            if not latencies:
+                return 0.0
+            return latencies[min(len(latencies) - 1, int(fraction * len(latencies)))] * 1000.0
+
+        batches = counters.get("batches", 0)
+        items = counters.get("reads_aligned", 0) + counters.get("pairs_aligned", 0)
+        return {"uptime_seconds": uptime,
+                "counters": dict(counters),
+                "mean_batch_size": float(items) / batches if batches else 0.0,
+                "reads_per_second": counters.get("reads_aligned", 0) / uptime if uptime else 0.0,
+                "requests_per_second": counters.get("requests", 0) / uptime if uptime else 0.0,
+                "latency_ms": {"mean": sum(latencies) * 1000.0 / len(latencies) if latencies else 0.0,
+                               "p50": percentile(0.50),
+                               "p95": percentile(0.95),
+                               "p99": percentile(0.99),
+                               "max": latencies[-1] * 1000.0 if latencies else 0.0},
+                "durations": dict(self.stats.durations)}
+
+
+class MicroBatcher:
+    """
+    Collects items submitted by concurrent requests into batches for the worker pool
+
+    submit(group, task_args, item, attachment) returns a future of the item's
+        result. Items are batched with others of the same group, whose task_args
+        describe the whole batch, such as the key of the template they are
+        aligned against
+    The task sent to align_batch is task_args + (items, None). When align_batch
+        returns None it is sent again as task_args + (items, attachment)
+    """
+    def __init__(self, pool, workers, max_batch=DEFAULT_MAX_BATCH, max_delay=DEFAULT_MAX_DELAY, stats=None):
+        self.pool = pool
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.stats = stats
+        self.queue = asyncio.Queue()
+        # Batches running at once, enough to keep every worker busy with one queued behind it
+        self.running = asyncio.Semaphore(2 * workers)
+        self.collector = None
+
+    def start(self):
+        self.collector = asyncio.ensure_future(self.collect())
+
+    async def stop(self):
+        if self.collector is not None:
+            self.collector.cancel()
+            try:
+                await self.collector
+            except asyncio.CancelledError:
+                pass
+
+    def submit(self, group, task_args, item, attachment=None):
+        future = asyncio.get_running_loop().create_future()
+        self.queue.put_nowait((group, task_args, attachment, item, future))
+        return future
+
+    async def collect(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_delay
+            while len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            groups = collections.OrderedDict()
+            for group, task_args, attachment, item, future in batch:
+                groups.setdefault(group, (task_args, attachment, []))[2].append((item, future))
+            for group, (task_args, attachment, entries) in groups.items():
+                await self.running.acquire()
+                asyncio.ensure_future(self.run_batch(group, task_args, attachment, entries))
+
+    async def run_batch(self, group, task_args, attachment, entries):
+        loop = asyncio.get_running_loop()
+        try:
+            items = [item for item, future in entries]
+            start = time.perf_counter()
+            try:
+                results = await loop.run_in_executor(self.pool, align_batch, task_args + (items, None))
+                if results is None:
+                    # The worker did not hold the attachment yet, it keeps it from now on
+                    if self.stats is not None:
+                        self.stats.count("attachments_sent")
+                    results = await loop.run_in_executor(self.pool, align_batch,
+                                                         task_args + (items, attachment))
+            except Exception as error:
+                for item, future in entries:
+                    if not future.done():
+                        future.set_exception(error)
+                return
+            if self.stats is not None:
+                self.stats.count("batches")
+                self.stats.count(group[0] + "_aligned", len(entries))
+                self.stats.stats.add_time("batch_align", time.perf_counter() - start)
+            for (item, future), result in zip(entries, results):
+                if not future.done():
+                    future.set_result(result)
+        finally:
+            self.running.release()
+
+
+class AlignmentServer:
+    def __init__(self, workers=None, max_batch=DEFAULT_MAX_BATCH, max_delay=DEFAULT_MAX_DELAY):
+        self.workers = workers or os.cpu_count() or 1
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.templates = {}
+        self.stats = ServerStats()
+        self.pool = None
+        self.batcher = None
+        self.server = None
+        self.address = None
+        self.connections = set()
+        self.stopping = None
+
+        self.operations = {"load_template": self.load_template,
+                           "unload_template": self.unload_template,
+                           "templates": self.list_templates,
+                           "align": self.align,
+                           "pair": self.pair,
+                           "assemble": self.assemble,
+                           "stats": self.report_stats}
+
+    async def start(self, address):
+        """
+        Starts the worker pool and listens on an address from parse_address
+        """
+        self.pool = concurrent.futures.ProcessPoolExecutor(self.workers)
+        self.batcher = MicroBatcher(self.pool, self.workers, self.max_batch, self.max_delay, self.stats)
+        self.batcher.start()
+        self.address = address
+        self.stopping = asyncio.Event()
+        kind, location = address
+        if kind == "unix":
+            self.server = await asyncio.start_unix_server(self.handle_connection, location, limit=MAX_LINE_BYTES)
+        else:
+            self.server = await asyncio.start_server(self.handle_connection, location[0], location[1],
+                                                     limit=MAX_LINE_BYTES)
+
+    async def serve_forever(self, address):
+        """
+        Serves until stop() is called or the process gets SIGINT or SIGTERM
+        """
+        await self.start(address)
+        loop = asyncio.get_running_loop()
+        for signal_number in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(signal_number, self.stop)
+            except (NotImplementedError, RuntimeError):
+                # Signal handlers cannot be set on Windows event loops
+                pass
+        try:
+            await self.stopping.wait()
+        finally:
+            await self.close()
+
+    def stop(self):
+        self.stopping.set()
+
+    async def close(self):
+        if self.server is not None:
+            self.server.close()
+            for writer in list(self.connections):
+                writer.close()
+            await self.server.wait_closed()
+            if self.address[0] == "unix" and os.path.exists(self.address[1]):
+                os.remove(self.address[1])
+        if self.batcher is not None:
+            await self.batcher.stop()
+        if self.pool is not None:
+            self.pool.shutdown(wait=False)
+
+    async def handle_connection(self, reader, writer):
+        write_lock = asyncio.Lock()
+        pending = set()
+        self.connections.add(writer)
+        try:
+            while True:
+                try:
+                    line = await reader.readline()
+                except (ValueError, asyncio.LimitOverrunError):
+                    await self.respond(writer, write_lock, {"error": "request line too long"})
+                    break
+                if not line:
+                    break
+                if not line.strip():
+                    continue
+                # Requests on one connection are served concurrently, so they batch together
+                task = asyncio.ensure_future(self.handle_line(line, writer, write_lock))
+                pending.add(task)
+                task.add_done_callback(pending.discard)
+            if pending:
+                await asyncio.wait(pending)
+        except ConnectionError:
+            pass
+        finally:
+            self.connections.discard(writer)
+            writer.close()
+
+    async def handle_line(self, line, writer, write_lock):
+        start = time.perf_counter()
+        request_id = None
+        op = "invalid"
+        try:
+            request = json.loads(line.decode("utf-8"))
+            if not isinstance(request, dict):
+                raise RequestError("a request must be a JSON object")
+            request_id = request.get("id")
+            op = request.get("op")
+            if op not in self.operations:
+                raise RequestError("unknown op %r" % (op,))
+            response = await self.operations[op](request)
+        except RequestError as error:
+            self.stats.count("errors")
+            response = {"error": str(error)}
+        except KeyError as error:
+            self.stats.count("errors")
+            response = {"error": "missing field %s" % error}
+        except Exception as error:
+            # Bad values and failures in a worker are reported, the server carries on
+            self.stats.count("errors")
+            response = {"error": "%s: %s" % (type(error).__name__, error)}
+        response["id"] = request_id
+        self.stats.request_done(op if op in self.operations else "invalid", time.perf_counter() - start)
+        await self.respond(writer, write_lock, response)
+
+    async def respond(self, writer, write_lock, response):
+        data = (json.dumps(response) + "\n").encode("utf-8")
+        async with write_lock:
+            writer.write(data)
+            try:
+                await writer.drain()
+            except ConnectionError:
+                pass
+
+    def get_template(self, request):
+        name = request["template"]
+        if name not in self.templates:
+            raise RequestError("no template loaded as %r" % (name,))
+        return self.templates[name]
+
+    def reads(self, request):
+        reads = request["reads"]
+        if not isinstance(reads, list) or not all(isinstance(read, str) for read in reads):
+            raise RequestError("reads must be a list of strings")
+        return reads
+
+    async def load_template(self, request):
+        name = request["name"]
+        if "template" in request:
+            sequence = request["template"]
+        elif "file" in request:
+            sequence = next(iterate_sequences(request["file"]), None)
+            if sequence is None:
+                raise RequestError("%s holds no sequences" % request["file"])
+        else:
+            raise RequestError("load_template needs a template or a file")
+        matrix_name = request.get("matrix")
+        if matrix_name:
+            # Fails here rather than in a worker when the matrix is missing or does not cover the template
+            load_matrix(matrix_name).encode(sequence, remember=False)
+        template = Template(name, sequence, request.get("seed_length"), matrix_name)
+        self.templates[name] = template
+        return template.describe()
+
+    async def unload_template(self, request):
+        name = request["name"]
+        if name not in self.templates:
+            raise RequestError("no template loaded as %r" % (name,))
+        return self.templates.pop(name).describe()
+
+    async def list_templates(self, request):
+        return {"templates": [self.templates[name].describe() for name in sorted(self.templates)]}
+
+    def align_reads(self, template, reads):
+        """
+        Submits reads to the batcher, returning the futures of their results
+        """
+        task_args = ("reads", template.key, template.seed_length, template.matrix_name)
+        group = ("reads", template.key)
+        return [self.batcher.submit(group, task_args, read, template.sequence) for read in reads]
+
+    async def align(self, request):
+        template = self.get_template(request)
+        results = await asyncio.gather(*self.align_reads(template, self.reads(request)))
+        return {"results": list(results)}
+
+    async def pair(self, request):
+        pair = (request["sequence_a"], request["sequence_b"])
+        matrix_name = request.get("matrix")
+        if matrix_name:
+            load_matrix(matrix_name)
+        result = await self.batcher.submit(("pairs", matrix_name), ("pairs", matrix_name), pair)
+        return {"result": result}
+
+    async def assemble(self, request):
+        template = self.get_template(request)
+        reads = self.reads(request)
+        results = await asyncio.gather(*self.align_reads(template, reads))
+        # Sorting is stable and results are in read order, so ties keep the serial order
+        order = sorted(range(len(reads)), key=lambda index: results[index]["relative_position"])
+        return {"sequence": SmithWatermantask2.merge_strings([reads[index] for index in order])}
+
+    async def report_stats(self, request):
+        statistics = self.stats.to_dict()
+        statistics["templates"] = len(self.templates)
+        statistics["workers"] = self.workers
+        return statistics
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Serves local alignments from resident templates")
+    parser.add_argument("--host", default=DEFAULT_HOST,
+                        help="address to listen on, localhost by default")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT,
+                        help="TCP port to listen on")
+    parser.add_argument("--unix-socket", metavar="PATH", default=None,
+                        help="listen on this Unix domain socket instead of TCP")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="worker processes aligning batches, one per CPU by default")
+    parser.add_argument("--max-batch", type=int, default=DEFAULT_MAX_BATCH,
+                        help="largest number of reads or pairs aligned in one batch")
+    parser.add_argument("--max-delay", type=float, default=DEFAULT_MAX_DELAY,
+                        help="seconds a batch waits for more requests after its first")
+    parser.add_argument("--template", nargs=2, action="append", default=[], metavar=("NAME", "FILE"),
+                        help="load the first sequence of FILE as template NAME on startup")
+    return parser.parse_args()
+
+
+def main():
+    arguments = parse_arguments()
+    if arguments.unix_socket:
+        address = ("unix", arguments.unix_socket)
+    else:
+        address = ("tcp", (arguments.host, arguments.port))
+
+    server = AlignmentServer(workers=arguments.workers,
+                             max_batch=arguments.max_batch,
+                             max_delay=arguments.max_delay)
+    for name, file_name in arguments.template:
+        server.templates[name] = Template(name, next(iterate_sequences(file_name)))
+
+    print("Serving alignments on %s" % (address[1] if address[0] == "unix" else "%s:%d" % address[1]),
+          file=sys.stderr)
+    asyncio.run(server.serve_forever(address))
+
+
+if __name__ == "__main__":
+    main()
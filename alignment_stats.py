@@ -0,0 +1,108 @@
+import sys
+import json
+import time
+
+"""
+Opt-in instrumentation shared by the aligners and their entry points
+
+An aligner given an AlignmentStats records how long each phase took and
+counts the work done in it:
+    allocate         - building the matrices in __init__
+    align            - filling the matrices
+    traceback        - following arrows back from the end cell
+    cells            - Dynamic Programming cells computed
+    traceback_nodes  - cells visited while tracing back
+    bytes_allocated  - size of the Optimal and Direction Matrices
+    cache_hits       - results found in an AlignmentCache, cache_disk_hits of them on disk
+    cache_misses     - results an AlignmentCache did not hold
+    sort_runs        - runs of read placements the assembly sorted on disk
+Aligners default to stats=None and then skip all of this, phase() hands back
+a shared do-nothing timer so the only cost is one None check per phase.
+One AlignmentStats can be shared by every aligner of a run to aggregate them.
+"""
+
+
+class AlignmentStats:
+    def __init__(self):
+        self.durations = {}
+        self.counters = {}
+
+    def add_time(self, phase_name, seconds):
+        self.durations[phase_name] = self.durations.get(phase_name, 0.0) + seconds
+
+    def count(self, counter_name, amount=1):
+        self.counters[counter_name] = self.counters.get(counter_name, 0) + amount
+
+    def merge(self, other):
+        for phase_name, seconds in other.durations.items():
+            self.add_time(phase_name, seconds)
+        for counter_name, amount in other.counters.items():
+            self.count(counter_name, amount)
+
+    def to_dict(self):
+        return {"durations": dict(self.durations), "counters": dict(self.counters)}
+
+    def summary(self):
+        lines = ["___Alignment Statistics___"]
+        for phase_name in sorted(self.durations):
+            lines.append("%-20s %12.6f s" % (phase_name, self.durations[phase_name]))
+        for counter_name in sorted(self.counters):
+            lines.append("%-20s %12d" % (counter_name, self.counters[counter_name]))
+        return "\n".join(lines)
+
+    def report(self, destination):
+        """
+        Prints the summary to stderr when destination is '-', otherwise writes JSON to that file
+        """
+        if destination == "-":
+            print(self.summary(), file=sys.stderr)
+        else:
+            with open(destination, "w") as output_file:
+                json.dump(self.to_dict(), output_file, indent=2, sort_keys=True)
+
+
+class PhaseTimer:
+    def __init__(self, stats, phase_name):
+        self.stats = stats
+        self.phase_name = phase_name
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.stats.add_time(self.phase_name, time.perf_counter() - self.start)
+        return False
+
+
+class NullTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        return False
+
+
+NULL_TIMER = NullTimer()
+
+
+def phase(stats, phase_name):
+    """
+    Context manager timing a phase into stats, or doing nothing when stats is None
+    """
+    if stats is None:
+        return NULL_TIMER
+    return PhaseTimer(stats, phase_name)
+
+
+def matrix_bytes(matrix):
+    """
+    Approximate memory held by a matrix, a list of lists or anything with nbytes
+    """
+    if matrix is None:
+        return 0
+    nbytes = getattr(matrix, "nbytes", None)
+    if nbytes is not None:
+        return nbytes
+    return sys.getsizeof(matrix) + sum(sys.getsizeof(row) for row in matrix)
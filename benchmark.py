@@ -0,0 +1,246 @@
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import tracemalloc
+
+import SmithWatermantask2
+from NeedlemanWunch import NeedlemanWunch
+from smithwatermantask1 import SmithWaterman
+
+"""
+Benchmarks each stage of the three alignment modules on seeded synthetic inputs
+
+For every stage, case and size it reports the best wall time over the repeats,
+cells per second and the peak memory traced while the stage runs once more
+under tracemalloc. Cells are the Dynamic Programming cells of the matrix, or
+the symbols merged for merge_strings.
+
+Cases:
+    random      - uniform ACGT sequences, the second sequence about 10% mutated
+    repetitive  - tandem repeats, the worst case for co-optimal tracebacks
+
+Usage:
+python benchmark.py [--sizes 50,100,200] [--output results.json] [--compare old.json]
+
+Example, failing if any stage got more than 25% slower than a saved run:
+python benchmark.py --output new.json --compare old.json --threshold 1.25
+"""
+
+STAGES = ("nw_align", "sw_align", "nw_recurse_tree", "sw_recurse_tree", "merge_strings", "assembly")
+CASES = ("random", "repetitive")
+
+
+def random_sequence(rng, length):
+    return "".join(rng.choice("ACGT") for i in range(length))
+
+
+def mutate(rng, sequence, rate=0.1):
+    symbols = list(sequence)
+    for i in range(len(symbols)):
+        if rng.random() < rate:
+            symbols[i] = rng.choice("ACGT")
+    return "".join(symbols)
+
+
+def make_pair(rng, case, size):
+    if case == "repetitive":
+        return ("AT" * size)[:size], ("TA" * size)[:size]
+    sequence_a = random_sequence(rng, size)
+    return sequence_a, mutate(rng, sequence_a)
+
+
+def make_reads(rng, case, size):
+    """
+    Returns a template of length size and overlapping exact reads tiling it
+    """
+    if case == "repetitive":
+        template = ("ACGTT" * size)[:size]
+    else:
+        template = random_sequence(rng, size)
+    read_length = max(6, size // 8)
+    step = max(1, read_length // 2)
+    reads = [template[i:i+read_length] for i in range(0, max(1, size - read_length + 1), step)]
+    rng.shuffle(reads)
+    return template, reads
+
+
+def silently(function):
+    """
+    Wraps function so that anything it prints is discarded
+    """
+    def run():
+        stdout = sys.stdout
+        with open(os.devnull, "w") as devnull:
+            sys.stdout = devnull
+            try:
+                return function()
+            finally:
+                sys.stdout = stdout
+    return run
+
+
+def prepare(stage, case, size, rng, traceback_limit):
+    """
+    Builds the inputs of a stage outside of the timed region
+    Returns the function to time and the number of cells it processes
+    """
+    if stage in ("nw_align", "nw_recurse_tree", "sw_align", "sw_recurse_tree"):
+        sequence_a, sequence_b = make_pair(rng, case, size)
+        cells = (len(sequence_a) + 1) * (len(sequence_b) + 1)
+
+        def new_aligner():
+            if stage.startswith("nw"):
+                return NeedlemanWunch(sequence_a, sequence_b, 1, 1, 1, 0)
+            return SmithWaterman(sequence_a, sequence_b, -1, -1, -3, 1, verbose=False)
+
+        if stage.endswith("align"):
+            def run():
+                new_aligner().align()
+            return silently(run), cells
+
+        aligner = silently(new_aligner)()
+        aligner.align()
+        if stage == "nw_recurse_tree":
+            return silently(lambda: aligner.output_alignments(limit=traceback_limit)), cells
+        return silently(lambda: aligner.print_alignments(limit=traceback_limit)), cells
+
+    template, reads = make_reads(rng, case, size)
+    if stage == "merge_strings":
+        ordered = sorted(reads, key=template.find)
+        return lambda: SmithWatermantask2.merge_strings(list(ordered)), sum(len(read) for read in reads)
+    if stage == "assembly":
+        cells = sum((len(template) + 1) * (len(read) + 1) for read in reads)
+        return lambda: SmithWatermantask2.assemble(template, list(reads)), cells
+    raise ValueError("Unknown stage: %s" % stage)
+
+
+def benchmark_stage(stage, case, size, seed, repeats, traceback_limit, measure_memory):
+    rng = random.Random("%s-%s-%d" % (case, seed, size))
+    run, cells = prepare(stage, case, size, rng, traceback_limit)
+
+    best = None
+    for repeat in range(repeats):
+        start = time.perf_counter()
+        run()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+
+    peak_bytes = None
+    if measure_memory:
+        tracemalloc.start()
+        try:
+            run()
+            peak_bytes = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    return {"stage": stage,
+            "case": case,
+            "size": size,
+            "cells": cells,
+            "seconds": best,
+            "cells_per_second": cells / best if best > 0 else None,
+            "peak_bytes": peak_bytes}
+
+
+def run_benchmarks(stages, cases, sizes, seed, repeats, traceback_limit, measure_memory):
+    results = []
+    for stage in stages:
+        for case in cases:
+            for size in sizes:
+                result = benchmark_stage(stage, case, size, seed, repeats, traceback_limit, measure_memory)
+                print_result(result)
+                results.append(result)
+    return {"meta": {"python": platform.python_version(),
+                     "platform": platform.platform(),
+                     "seed": seed,
+                     "repeats": repeats,
+                     "traceback_limit": traceback_limit},
+            "results": results}
+
+
+def print_result(result):
+    if result["peak_bytes"] is None:
+        peak = "-"
+    else:
+        peak = "%.1f KiB" % (result["peak_bytes"] / 1024.0)
+    print("%-16s %-11s %6d %10.4fs %14.0f cells/s %14s" % (result["stage"], result["case"], result["size"],
+                                                           result["seconds"], result["cells_per_second"] or 0,
+                                                           peak))
+
+
+def compare(previous, current, threshold):
+    """
+    Prints the time ratio of each stage against a previous run
+    Returns the results more than threshold times slower
+    """
+    previous_results = {}
+    for result in previous["results"]:
+        previous_results[(result["stage"], result["case"], result["size"])] = result
+
+    regressions = []
+    print("\n%-16s %-11s %6s %10s" % ("Stage", "Case", "Size", "Ratio"))
+    for result in current["results"]:
+        key = (result["stage"], result["case"], result["size"])
+        if key not in previous_results or not previous_results[key]["seconds"]:
+            continue
+        ratio = result["seconds"] / previous_results[key]["seconds"]
+        flag = ""
+        if ratio > threshold:
+            flag = "  REGRESSION"
+            regressions.append(result)
+        print("%-16s %-11s %6d %9.2fx%s" % (key[0], key[1], key[2], ratio, flag))
+    return regressions
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Benchmarks the alignment modules")
+    parser.add_argument("--sizes", default="50,100,200",
+                        help="comma separated sequence lengths")
+    parser.add_argument("--stages", default=",".join(STAGES),
+                        help="comma separated stages out of " + ", ".join(STAGES))
+    parser.add_argument("--cases", default=",".join(CASES),
+                        help="comma separated cases out of " + ", ".join(CASES))
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--repeats", type=int, default=3,
+                        help="timed runs per stage, the fastest is reported")
+    parser.add_argument("--traceback-limit", type=int, default=1000,
+                        help="alignments walked by the recurse_tree stages")
+    parser.add_argument("--no-memory", action="store_true",
+                        help="skip the tracemalloc run of each stage")
+    parser.add_argument("--output", default=None,
+                        help="save the results as JSON")
+    parser.add_argument("--compare", default=None,
+                        help="JSON results of an earlier run to compare against")
+    parser.add_argument("--threshold", type=float, default=1.25,
+                        help="slowdown ratio reported as a regression")
+    return parser.parse_args()
+
+
+def main():
+    arguments = parse_arguments()
+    sizes = [int(size) for size in arguments.sizes.split(",")]
+    stages = arguments.stages.split(",")
+    cases = arguments.cases.split(",")
+
+    results = run_benchmarks(stages, cases, sizes, arguments.seed, arguments.repeats,
+                             arguments.traceback_limit, not arguments.no_memory)
+
+    if arguments.output:
+        with open(arguments.output, "w") as output_file:
+            json.dump(results, output_file, indent=2, sort_keys=True)
+
+    if arguments.compare:
+        with open(arguments.compare) as previous_file:
+            previous = json.load(previous_file)
+        if compare(previous, results, arguments.threshold):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
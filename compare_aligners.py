@@ -0,0 +1,102 @@
+import sys
+import os
+import time
+import random
+
+from NeedlemanWunch import NeedlemanWunch, np
+from SmithWatermantask2 import TemplateAligner, get_input_directory, local_align
+from sequence_reader import iterate_sequences
+
+"""
+Compares read alignment throughput of SmithWaterman and TemplateAligner
+Every read of every input file in the inputs folder is aligned against that
+file's template with both, checking that they agree
+
+The NeedlemanWunch numpy engine is first checked against the python engine on
+random pairs, with float costs as well as integer ones, as both must fill
+exactly the same Optimal and Direction Matrices
+
+Usage:
+python compare_aligners.py [repeats]
+
+Example:
+python compare_aligners.py 20
+"""
+
+
+def read_input(file_name):
+    sequences = list(iterate_sequences(file_name))
+    return sequences[0], sequences[1:]
+
+
+def time_smith_waterman(template, reads, repeats):
+    start = time.perf_counter()
+    for repeat in range(repeats):
+        results = [local_align(template, read) for read in reads]
+    return time.perf_counter() - start, results
+
+
+def time_template_aligner(template, reads, repeats):
+    start = time.perf_counter()
+    for repeat in range(repeats):
+        template_aligner = TemplateAligner(template)
+        results = [template_aligner.align(read) for read in reads]
+    return time.perf_counter() - start, results
+
+
+# Costs the engines are checked with, (insertion, deletion, substitution, match)
+ENGINE_CHECK_COSTS = ((1, 1, 1, 0), (2, 3, 1, 0), (0.1, 0.2, 0.3, 0.0), (0.7, 0.1, 0.3, 0.05))
+
+
+def check_numpy_engine(pairs=150, seed=0):
+    """
+    Raises AssertionError when the numpy engine fills different matrices than the python engine
+    """
+    rng = random.Random(seed)
+    for pair in range(pairs):
+        sequence_a = "".join(rng.choice("ACGT") for i in range(rng.randint(0, 12)))
+        sequence_b = "".join(rng.choice("ACGT") for i in range(rng.randint(0, 12)))
+        costs = ENGINE_CHECK_COSTS[pair % len(ENGINE_CHECK_COSTS)]
+        python_engine = NeedlemanWunch(sequence_a, sequence_b, *costs, engine="python", verbose=False)
+        python_engine.align()
+        numpy_engine = NeedlemanWunch(sequence_a, sequence_b, *costs, engine="numpy", verbose=False)
+        numpy_engine.align()
+        if (numpy_engine.optimal.tolist() != python_engine.optimal or
+                numpy_engine.direction.tolist() != python_engine.direction.tolist()):
+            raise AssertionError("NeedlemanWunch engines disagree on %s, %s with costs %r" %
+                                 (sequence_a, sequence_b, costs))
+
+
+def main():
+    try:
+        repeats = int(sys.argv[1])
+    except IndexError:
+        repeats = 10
+
+    if np is not None:
+        check_numpy_engine()
+
+    input_directory = get_input_directory()
+    print("%-12s %6s %16s %18s %8s" % ("Input", "Reads", "SmithWaterman/s", "TemplateAligner/s", "Speedup"))
+    for file_name in sorted(os.listdir(input_directory)):
+        template, reads = read_input(os.path.join(input_directory, file_name))
+        if len(reads) == 0:
+            continue
+
+        serial_time, serial_results = time_smith_waterman(template, reads, repeats)
+        profile_time, profile_results = time_template_aligner(template, reads, repeats)
+
+        for serial, profile in zip(serial_results, profile_results):
+            if (serial.max_value, serial.max_indices, serial.relative_position) != \
+                    (profile.max_value, profile.max_indices, profile.relative_position):
+                raise AssertionError("Aligners disagree on %s in %s" % (serial.sequenceB, file_name))
+
+        aligned = len(reads) * repeats
+        print("%-12s %6d %16.0f %18.0f %7.2fx" % (file_name, len(reads),
+                                                 aligned / serial_time,
+                                                 aligned / profile_time,
+                                                 serial_time / profile_time))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+"""
+Compact storage for the Direction Matrix shared by the aligners
+
+A direction is a 3 bit LEFT/DIAGONAL/UP mask, so a list of lists of Python ints
+spends a pointer per cell on 3 bits of information. DirectionMatrix keeps every
+cell in one bytearray instead, or two cells per byte when packed, and still
+supports direction[i][j] reads and writes.
+"""
+
+
+class DirectionMatrix:
+    def __init__(self, rows, columns, packed=False):
+        self.rows = rows
+        self.columns = columns
+        self.packed = packed
+
+        if packed:
+            # Two 4 bit cells per byte, the even cell in the low nibble
+            self.cells = bytearray((rows * columns + 1) // 2)
+        else:
+            self.cells = bytearray(rows * columns)
+            self.view = memoryview(self.cells)
+
+    def __len__(self):
+        return self.rows
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self.rows
+        if not 0 <= i < self.rows:
+            raise IndexError("direction matrix row out of range")
+        if self.packed:
+            return PackedDirectionRow(self.cells, i * self.columns, self.columns)
+        # A memoryview slice reads and writes single bytes without copying the row
+        return self.view[i * self.columns:(i + 1) * self.columns]
+
+    def add_rows(self, count):
+        """
+        Appends count rows of zero cells
+        """
+        self.rows += count
+        if self.packed:
+            self.cells.extend(bytes((self.rows * self.columns + 1) // 2 - len(self.cells)))
+        else:
+            # A bytearray cannot grow while a view of it exists
+            self.view.release()
+            self.cells.extend(bytes(count * self.columns))
+            self.view = memoryview(self.cells)
+
+    def tolist(self):
+        return [list(self[i]) for i in range(self.rows)]
+
+    @property
+    def nbytes(self):
+        return len(self.cells)
+
+
+class PackedDirectionRow:
+    """
+    One row of a packed DirectionMatrix, indexed like a list
+    """
+    def __init__(self, cells, offset, length):
+        self.cells = cells
+        self.offset = offset
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+    def cell_index(self, j):
+        if j < 0:
+            j += self.length
+        if not 0 <= j < self.length:
+            raise IndexError("direction matrix column out of range")
+        return self.offset + j
+
+    def __getitem__(self, j):
+        k = self.cell_index(j)
+        return (self.cells[k >> 1] >> ((k & 1) * 4)) & 0xF
+
+    def __setitem__(self, j, value):
+        k = self.cell_index(j)
+        shift = (k & 1) * 4
+        self.cells[k >> 1] = (self.cells[k >> 1] & ~(0xF << shift) & 0xFF) | ((value & 0xF) << shift)
+
+    def __iter__(self):
+        for j in range(self.length):
+            yield self[j]
@@ -0,0 +1,135 @@
+import os
+import json
+import mmap
+import time
+import array
+
+"""
+Optimal and Direction Matrices kept in memory mapped files, for alignments
+too large to hold in RAM
+
+A DiskMatrix supports matrix[i][j] reads and writes like the nested lists it
+replaces, each row being a memoryview slice of the mapped file, so only the
+pages of the rows actually touched are read in. The fill writes rows in order
+and MatrixCheckpoint records the last row completed, flushing both files
+first, so an interrupted align() started again on the same directory resumes
+after that row instead of starting over.
+
+Files in the matrix directory:
+    optimal.bin      - one 8 byte integer or float per cell, row by row
+    direction.bin    - one byte per cell, row by row
+    checkpoint.json  - last completed row, the alignment it belongs to and the
+                       state the fill needs to carry on, such as max_value
+"""
+
+OPTIMAL_FILE = "optimal.bin"
+DIRECTION_FILE = "direction.bin"
+CHECKPOINT_FILE = "checkpoint.json"
+
+# Seconds of filling between two checkpoints
+CHECKPOINT_SECONDS = 30.0
+
+
+class DiskMatrix:
+    # Memory held by the matrix, the cells themselves live in the page cache
+    nbytes = 0
+
+    def __init__(self, file_name, rows, columns, typecode="q"):
+        self.file_name = file_name
+        self.rows = rows
+        self.columns = columns
+        self.typecode = typecode
+
+        size = rows * columns * array.array(typecode).itemsize
+        with open(file_name, "a+b") as matrix_file:
+            if os.path.getsize(file_name) != size:
+                matrix_file.truncate(size)
+            self.mapped_file = mmap.mmap(matrix_file.fileno(), size)
+        self.view = memoryview(self.mapped_file).cast(typecode)
+
+    def __len__(self):
+        return self.rows
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self.rows
+        if not 0 <= i < self.rows:
+            raise IndexError("disk matrix row out of range")
+        return self.view[i * self.columns:(i + 1) * self.columns]
+
+    def tolist(self):
+        return [list(self[i]) for i in range(self.rows)]
+
+    def flush(self):
+        self.mapped_file.flush()
+
+
+class MatrixCheckpoint:
+    """
+    Disk backed matrices of one alignment and the progress of its fill
+
+    fingerprint identifies the alignment, a checkpoint left by a different one is
+        discarded and the fill starts from the first row
+    first_row is the row the fill carries on from, and state the values saved
+        with the last checkpoint
+    """
+    def __init__(self, directory, rows, columns, fingerprint, float_costs=False,
+                 checkpoint_seconds=CHECKPOINT_SECONDS):
+        self.directory = directory
+        self.fingerprint = fingerprint
+        self.checkpoint_seconds = checkpoint_seconds
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        self.first_row = 1
+        self.state = {}
+        checkpoint = self.read_checkpoint()
+        if (checkpoint is not None and checkpoint["fingerprint"] == fingerprint and
+                checkpoint["rows"] == rows and checkpoint["columns"] == columns):
+            self.first_row = checkpoint["completed_row"] + 1
+            self.state = checkpoint["state"]
+
+        self.optimal = DiskMatrix(os.path.join(directory, OPTIMAL_FILE), rows, columns,
+                                  "d" if float_costs else "q")
+        self.direction = DiskMatrix(os.path.join(directory, DIRECTION_FILE), rows, columns, "B")
+        self.last_saved = time.time()
+
+    @property
+    def complete(self):
+        return self.first_row >= self.optimal.rows
+
+    def read_checkpoint(self):
+        try:
+            with open(os.path.join(self.directory, CHECKPOINT_FILE)) as checkpoint_file:
+                return json.load(checkpoint_file)
+        except (IOError, ValueError):
+            return None
+
+    def completed_row(self, i, state=None):
+        """
+        Called by the fill after each row, saves a checkpoint every checkpoint_seconds
+            and after the last row
+        """
+        if i == self.optimal.rows - 1 or time.time() - self.last_saved >= self.checkpoint_seconds:
+            self.save(i, state)
+
+    def save(self, i, state=None):
+        # The rows must be on disk before the checkpoint claims them
+        self.optimal.flush()
+        self.direction.flush()
+
+        checkpoint = {"fingerprint": self.fingerprint,
+                      "rows": self.optimal.rows,
+                      "columns": self.optimal.columns,
+                      "completed_row": i,
+                      "state": state or {}}
+        file_name = os.path.join(self.directory, CHECKPOINT_FILE)
+        with open(file_name + ".tmp", "w") as checkpoint_file:
+            json.dump(checkpoint, checkpoint_file)
+            checkpoint_file.flush()
+            os.fsync(checkpoint_file.fileno())
+        os.replace(file_name + ".tmp", file_name)
+
+        self.first_row = i + 1
+        self.state = checkpoint["state"]
+        self.last_saved = time.time()
@@ -0,0 +1,150 @@
+import sys
+
+import alignment_paths
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+"""
+Writes the Optimal and Direction Matrices of an aligner
+
+Each row is rendered into one string and written in a single call, to any file
+object. Matrices larger than the window are cut down to the cells around a
+centre cell, the end of the alignment by default, or around the cells of the
+first traceback path. save_matrices dumps the full tables to .npy files, one
+row at a time through a memory map, for inspection with numpy.load.
+"""
+
+# Largest number of rows and columns printed before the matrix is truncated
+DEFAULT_WINDOW = 60
+
+
+def end_cell(aligner):
+    """
+    Cell the alignment ends in, max_indices for a local aligner, the last cell otherwise
+    """
+    max_indices = getattr(aligner, "max_indices", None)
+    if max_indices is not None:
+        return max_indices[0], max_indices[1]
+    return len(aligner.sequenceA), len(aligner.sequenceB)
+
+
+def path_bounds(aligner):
+    """
+    Rows and columns spanned by the first traceback path, as (first_row, last_row, first_column, last_column)
+    """
+    end_d, end_a = end_cell(aligner)
+    if hasattr(aligner, "is_alignment_start"):
+        is_start = aligner.is_alignment_start
+    else:
+        is_start = aligner.is_origin
+    for top, bottom, start_d, start_a in alignment_paths.iterate_alignments(
+            aligner, end_d, end_a, is_start, limit=1):
+        return start_d, end_d, start_a, end_a
+    return end_d, end_d, end_a, end_a
+
+
+def clip_range(first, last, size, window):
+    """
+    Half open range of at most window indices out of size, centred on first to last
+        when they fit and on last otherwise
+    """
+    if size <= window:
+        return 0, size
+    span = last - first + 1
+    if span <= window:
+        start = first - (window - span) // 2
+    else:
+        start = last - window // 2
+    start = max(0, min(start, size - window))
+    return start, start + window
+
+
+def matrix_window(aligner, window=DEFAULT_WINDOW, around="end"):
+    """
+    Returns the (rows, columns) ranges of the matrices to print
+    around is "end" to centre on the end cell or "path" to cover the first traceback path
+    """
+    row_count = len(aligner.sequenceA) + 1
+    column_count = len(aligner.sequenceB) + 1
+    if window is None or (row_count <= window and column_count <= window):
+        return range(row_count), range(column_count)
+
+    if around == "path":
+        first_row, last_row, first_column, last_column = path_bounds(aligner)
+    else:
+        last_row, last_column = end_cell(aligner)
+        first_row, first_column = last_row, last_column
+
+    rows = range(*clip_range(first_row, last_row, row_count, window))
+    columns = range(*clip_range(first_column, last_column, column_count, window))
+    return rows, columns
+
+
+def write_matrix(output_file, title, matrix, sequence_a, sequence_b, rows, columns):
+    output_file.write("\n %s %s %s\n" % ("_"*7, title, "_"*7))
+    if len(rows) < len(sequence_a) + 1 or len(columns) < len(sequence_b) + 1:
+        output_file.write("(rows %d-%d of %d, columns %d-%d of %d)\n" % (
+            rows[0], rows[-1], len(sequence_a), columns[0], columns[-1], len(sequence_b)))
+
+    labels = [sequence_b[j-1] if j >= 1 else "" for j in columns]
+    output_file.write("\t" + "\t".join(labels) + "\n")
+
+    lines = []
+    for i in rows:
+        row = matrix[i]
+        label = sequence_a[i-1] if i >= 1 else ""
+        lines.append(label + "\t" + "\t".join([str(row[j]) for j in columns]) + "\t\n")
+        # Flush in blocks so a huge window never builds one huge string
+        if len(lines) >= 256:
+            output_file.write("".join(lines))
+            del lines[:]
+    output_file.write("".join(lines))
+
+
+def write_matrices(aligner, output_file=None, window=DEFAULT_WINDOW, around="end"):
+    """
+    Writes the Optimal and Direction Matrices, truncated to window rows and columns
+    Pass window=None to always write the whole matrices
+    """
+    if output_file is None:
+        output_file = sys.stdout
+    rows, columns = matrix_window(aligner, window, around)
+    write_matrix(output_file, "Optimal Matrix", aligner.optimal,
+                 aligner.sequenceA, aligner.sequenceB, rows, columns)
+    write_matrix(output_file, "Direction Matrix", aligner.direction,
+                 aligner.sequenceA, aligner.sequenceB, rows, columns)
+
+
+def save_matrices(aligner, prefix):
+    """
+    Saves the full matrices to prefix_optimal.npy and prefix_direction.npy
+    Rows are copied one at a time into memory mapped files, so the matrices
+        are never held twice in memory
+    Returns the two file names
+    """
+    if np is None:
+        raise ImportError("Saving matrices requires NumPy to be installed")
+
+    shape = (len(aligner.sequenceA) + 1, len(aligner.sequenceB) + 1)
+    costs = (aligner.insert, aligner.delete, aligner.substitution, aligner.match_cost)
+    if (getattr(aligner, "engine", None) == "banded" or any(isinstance(cost, float) for cost in costs) or
+            aligner.substitution_matrix.has_float_scores()):
+        # Banded matrices hold inf outside the band
+        optimal_dtype = np.float64
+    else:
+        optimal_dtype = np.int64
+
+    file_names = (prefix + "_optimal.npy", prefix + "_direction.npy")
+    for file_name, matrix, dtype in zip(file_names,
+                                        (aligner.optimal, aligner.direction),
+                                        (optimal_dtype, np.uint8)):
+        stored = np.lib.format.open_memmap(file_name, mode="w+", dtype=dtype, shape=shape)
+        for i in range(shape[0]):
+            row = matrix[i]
+            stored[i] = [row[j] for j in range(shape[1])]
+        stored.flush()
+        del stored
+    return file_names
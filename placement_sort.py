@@ -0,0 +1,116 @@
+import sys
+import json
+import heapq
+import tempfile
+
+"""
+Compact read placements and an external merge sort ordering them by where
+they align on the template
+
+A ReadPlacement keeps the three values the assembly needs from an alignment,
+so the Optimal and Direction Matrices of each read can be dropped as soon as
+it is aligned. PlacementSorter holds placements in memory up to a byte budget,
+then sorts them and spills them to a temporary file as one run. sorted()
+merges the runs back lazily, so placements stream out in order while at most
+one line per run is held in memory.
+
+Placements with equal relative_position come out in the order they were added,
+as with the stable in-memory sort the assembly used before.
+"""
+
+# Bytes of placements held in memory before they are spilled to a run file
+DEFAULT_MEMORY_BUDGET = 64 * 1024 * 1024
+
+
+class ReadPlacement:
+    """
+    Where one read aligns on the template
+    """
+    __slots__ = ("read", "relative_position", "score")
+
+    def __init__(self, read, relative_position, score):
+        self.read = read
+        self.relative_position = relative_position
+        self.score = score
+
+    def __repr__(self):
+        return "ReadPlacement(%r, %r, %r)" % (self.read, self.relative_position, self.score)
+
+    def size(self):
+        """
+        Approximate bytes of memory held by the placement and its read
+        """
+        return sys.getsizeof(self) + sys.getsizeof(self.read)
+
+
+def placement_key(placement):
+    return placement.relative_position
+
+
+class PlacementSorter:
+    def __init__(self, memory_budget=DEFAULT_MEMORY_BUDGET, directory=None):
+        self.memory_budget = memory_budget
+        # Directory of the run files, the system temporary directory when None
+        self.directory = directory
+
+        self.placements = []
+        self.held_bytes = 0
+        self.runs = []
+
+        self.count = 0
+        # Length of the longest read added, the most of a contig a read can overlap
+        self.longest_read = 0
+
+    def add(self, placement):
+        self.placements.append(placement)
+        self.held_bytes += placement.size()
+        self.count += 1
+        self.longest_read = max(self.longest_read, len(placement.read))
+        if self.held_bytes > self.memory_budget:
+            self.spill()
+
+    def spill(self):
+        """
+        Sorts the placements held in memory and writes them out as a new run
+        """
+        self.placements.sort(key=placement_key)
+        run = tempfile.TemporaryFile("w+", dir=self.directory)
+        for placement in self.placements:
+            run.write(json.dumps([placement.relative_position, placement.score, placement.read]) + "\n")
+        run.seek(0)
+        self.runs.append(run)
+        self.placements = []
+        self.held_bytes = 0
+
+    def sorted(self):
+        """
+        Returns an iterator over every placement added, ordered by relative_position
+        The placements held in memory are sorted here, the runs are merged as it is read
+        """
+        self.placements.sort(key=placement_key)
+        if not self.runs:
+            return iter(self.placements)
+        return self.merge_runs()
+
+    def merge_runs(self):
+        # Runs were spilled in input order and the held placements come last,
+        # heapq.merge takes ties from earlier iterables first so the order stays stable
+        try:
+            for placement in heapq.merge(*[read_run(run) for run in self.runs] + [self.placements],
+                                         key=placement_key):
+                yield placement
+        finally:
+            self.close()
+
+    def close(self):
+        for run in self.runs:
+            run.close()
+        self.runs = []
+        self.placements = []
+        self.held_bytes = 0
+
+
+def read_run(run):
+    for line in run:
+        relative_position, score, read = json.loads(line)
+        yield ReadPlacement(read, relative_position, score)
@@ -0,0 +1,123 @@
+import gzip
+import mmap
+
+"""
+Streaming reader for the sequence files used by all three entry points
+
+Records are yielded one at a time, so memory does not grow with the file.
+The format is detected from the file itself:
+    gzip        - any of the formats below, compressed
+    FASTA       - '>' header lines, sequence may span several lines
+    FASTQ       - four line records, '@' header, sequence, '+', qualities
+    plain lines - one sequence per line, as in the inputs folder
+Blank lines are skipped in every format.
+"""
+
+GZIP_MAGIC = b"\x1f\x8b"
+
+# Uncompressed files at least this large are read through mmap
+MMAP_THRESHOLD = 64 * 1024 * 1024
+
+
+class SequenceRecord:
+    __slots__ = ("name", "sequence", "quality")
+
+    def __init__(self, name, sequence, quality=None):
+        self.name = name
+        self.sequence = sequence
+        self.quality = quality
+
+
+def iterate_lines(file_name):
+    """
+    Yields the stripped, non-blank lines of a plain or gzip compressed file
+    """
+    with open(file_name, "rb") as binary_file:
+        magic = binary_file.read(2)
+        binary_file.seek(0)
+
+        if magic == GZIP_MAGIC:
+            with gzip.open(binary_file, "rb") as compressed_file:
+                for line in compressed_file:
+                    line = line.strip()
+                    if line:
+                        yield line.decode("utf-8")
+            return
+
+        size = binary_file.seek(0, 2)
+        binary_file.seek(0)
+        if size >= MMAP_THRESHOLD:
+            mapped_file = mmap.mmap(binary_file.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                for line in iter(mapped_file.readline, b""):
+                    line = line.strip()
+                    if line:
+                        yield line.decode("utf-8")
+            finally:
+                mapped_file.close()
+            return
+
+        for line in binary_file:
+            line = line.strip()
+            if line:
+                yield line.decode("utf-8")
+
+
+def iterate_records(file_name):
+    """
+    Lazily yields a SequenceRecord for each sequence in the file
+    Plain line records have no name
+    """
+    lines = iterate_lines(file_name)
+    first_line = next(lines, None)
+    if first_line is None:
+        return
+
+    if first_line.startswith(">"):
+        name = first_line[1:]
+        sequence = []
+        for line in lines:
+            if line.startswith(">"):
+                yield SequenceRecord(name, "".join(sequence))
+                name = line[1:]
+                sequence = []
+            else:
+                sequence.append(line)
+        yield SequenceRecord(name, "".join(sequence))
+
+    elif first_line.startswith("@"):
+        header = first_line
+        while header is not None:
+            sequence = next(lines, None)
+            separator = next(lines, None)
+            quality = next(lines, None)
+            if quality is None or not separator.startswith("+"):
+                raise ValueError("Truncated or malformed FASTQ record: %s" % header)
+            yield SequenceRecord(header[1:], sequence, quality)
+            header = next(lines, None)
+
+    else:
+        yield SequenceRecord(None, first_line)
+        for line in lines:
+            yield SequenceRecord(None, line)
+
+
+def iterate_sequences(file_name):
+    """
+    Lazily yields just the sequence of each record in the file
+    """
+    for record in iterate_records(file_name):
+        yield record.sequence
+
+
+def iterate_pairs(file_name):
+    """
+    Lazily yields consecutive records as (sequence_a, sequence_b) pairs
+    A trailing unpaired record is ignored
+    """
+    sequences = iterate_sequences(file_name)
+    for sequence_a in sequences:
+        sequence_b = next(sequences, None)
+        if sequence_b is None:
+            return
+        yield sequence_a, sequence_b
@@ -1,31 +1,75 @@
-import sys
 import os
+import argparse
+import collections
+import json
+import multiprocessing
+
+import alignment_paths
+import matrix_export
+from alignment_cache import AlignmentCache, cache_key
+from alignment_stats import AlignmentStats, matrix_bytes, phase
+from direction_matrix import DirectionMatrix
+from disk_matrix import MatrixCheckpoint
+from sequence_reader import iterate_pairs
+from substitution_matrix import identity_matrix, load_matrix
 
 """
-Reads in two lines at a time from an input file and performs a local
-alignment on each of these pairs of lines
+Reads in two sequences at a time from an input file and performs a local
+alignment on each of these pairs of sequences
+The input may be plain lines, FASTA or FASTQ, optionally gzip compressed
 
 Usage:
 python smithwatermantask1.py input_file
 
 Example:
 python smithwatermantask1.py output4.txt
+
+Batch mode aligns the pairs on a process pool and writes one record per pair,
+in input order, as TSV or JSON Lines instead of printing the matrices:
+python smithwatermantask1.py input_file --batch results.tsv [--workers N]
+python smithwatermantask1.py input_file --batch results.jsonl --format jsonl
+
+Add --cache FILE in batch mode to look up pairs aligned by earlier runs in a
+SQLite file instead of aligning them again
+
+Add --matrix NAME to score symbol pairs with a substitution matrix, such as DNA or
+BLOSUM62 from the matrices folder, instead of the match and substitution costs
+
+Add --matrix-dir DIR to keep the matrices of very large alignments in memory
+mapped files, running the same command again resumes an interrupted fill
+
+Add --stats to print phase timings and work counts, or --stats FILE to save them as JSON
 """
 
+# Columns of a batch result record, in TSV order
+RESULT_FIELDS = ("sequence_a", "sequence_b", "score",
+                 "start_a", "start_b", "end_a", "end_b",
+                 "alignment_a", "alignment_b")
+
 
 class SmithWaterman:
+    # Store two direction cells per byte instead of one
+    # A byte per cell keeps the Direction Matrix in about 8 times less memory than a list
+    # of lists, only packing takes it below a tenth, about 16 times less
+    pack_directions = False
+
     def __init__(self, sequence_a, sequence_b,
                  insertion_cost,
                  deletion_cost,
                  substitution_cost,
-                 match_cost):
+                 match_cost,
+                 verbose=True,
+                 stats=None,
+                 matrix_directory=None,
+                 substitution_matrix=None):
 
         # Input Sequences
         self.sequenceA = sequence_a  # Y Sequence
         self.sequenceB = sequence_b  # X Sequence
 
-        print("Sequence A:", self.sequenceA)
-        print("Sequence B:", self.sequenceB)
+        if verbose:
+            print("Sequence A:", self.sequenceA)
+            print("Sequence B:", self.sequenceB)
 
         # Edit Costs
         self.insert = insertion_cost
@@ -33,13 +77,44 @@ class SmithWaterman:
         self.substitution = substitution_cost
         self.match_cost = match_cost
 
-        # Optimal Matrix
-        self.optimal = [[0 for x in range(len(self.sequenceB)+1)]
-                        for x in range(len(self.sequenceA)+1)]
+        # Score of pairing each two symbols, match_cost and substitution_cost by default
+        if substitution_matrix is None:
+            substitution_matrix = identity_matrix(match_cost, substitution_cost)
+        self.substitution_matrix = substitution_matrix
+
+        # Sequences as substitution matrix codes
+        self.codes_a = substitution_matrix.encode(self.sequenceA)
+        self.codes_b = substitution_matrix.encode(self.sequenceB)
+
+        # Optional AlignmentStats recording phase durations and work counts
+        self.stats = stats
+
+        # Set by align(), extend_sequence_a then fills the rows it adds
+        self.aligned = False
+
+        # With matrix_directory the matrices are kept in files there, resuming the
+        # fill of an interrupted align() on the same sequences and costs
+        self.checkpoint = None
+
+        with phase(stats, "allocate"):
+            if matrix_directory is not None:
+                costs = (insertion_cost, deletion_cost, substitution_cost, match_cost)
+                self.checkpoint = MatrixCheckpoint(matrix_directory,
+                                                   len(self.sequenceA)+1, len(self.sequenceB)+1,
+                                                   cache_key("smithwatermantask1.SmithWaterman " + substitution_matrix.name,
+                                                             self.sequenceA, self.sequenceB, *costs),
+                                                   float_costs=any(isinstance(cost, float) for cost in costs) or
+                                                   substitution_matrix.has_float_scores())
+                self.optimal = self.checkpoint.optimal
+                self.direction = self.checkpoint.direction
+            else:
+                # Optimal Matrix
+                self.optimal = [[0 for x in range(len(self.sequenceB)+1)]
+                                for x in range(len(self.sequenceA)+1)]
 
-        # Direction Matrix
-        self.direction = [[0 for x in range(len(self.sequenceB)+1)]
-                          for x in range(len(self.sequenceA)+1)]
+                # Direction Matrix
+                self.direction = DirectionMatrix(len(self.sequenceA)+1, len(self.sequenceB)+1,
+                                                 packed=self.pack_directions)
 
         # Direction Arrows, Direction value in Binary - 3 bits - can be [XYZ] = [UDL] ~ Up, Diagonal, Left
         self.LEFT = 1
@@ -48,30 +123,78 @@ class SmithWaterman:
 
         self.max_value = 0
         self.max_indices = [0, 0]
+        if self.checkpoint is not None and self.checkpoint.state:
+            self.max_value = self.checkpoint.state["max_value"]
+            self.max_indices = self.checkpoint.state["max_indices"]
 
 
     def align(self):
+        with phase(self.stats, "align"):
+            self.align_full()
+        self.aligned = True
+        if self.stats is not None:
+            self.stats.count("cells", len(self.sequenceA) * len(self.sequenceB))
+            self.stats.count("bytes_allocated", matrix_bytes(self.optimal) + matrix_bytes(self.direction))
+
+    def extend_sequence_a(self, symbols):
+        """
+        Appends symbols to sequenceA, filling only the new rows once aligned
+        Rows never depend on the symbols below them, so the matrices, max_value, max_indices
+            and alignments are the same as aligning the longer sequence from scratch
+        """
+        if self.checkpoint is not None:
+            raise ValueError("Matrices kept on disk cannot be extended")
+        first_row = len(self.sequenceA) + 1
+        self.sequenceA += symbols
+        self.codes_a += self.substitution_matrix.encode(symbols, remember=False)
+        with phase(self.stats, "allocate"):
+            self.optimal.extend([0 for x in range(len(self.sequenceB)+1)]
+                                for x in range(len(symbols)))
+            self.direction.add_rows(len(symbols))
+        if not self.aligned:
+            return
+
+        with phase(self.stats, "align"):
+            for i in range(first_row, len(self.sequenceA)+1):
+                self.optimal[i][0] = 0
+                self.direction[i][0] = self.UP
+            self.fill_rows(first_row)
+        if self.stats is not None:
+            self.stats.count("cells", len(symbols) * len(self.sequenceB))
+
+    def align_full(self):
+        # Rows before first_row were filled by an earlier, interrupted align()
+        first_row = 1 if self.checkpoint is None else self.checkpoint.first_row
+
         # Compute insertions and deletions for 1st row and 1st column
         # Set the values of row 0 and column 0
-        self.optimal[0][0] = 0
-        self.direction[0][0] = self.DIAGONAL
+        if first_row == 1:
+            self.optimal[0][0] = 0
+            self.direction[0][0] = self.DIAGONAL
+
+            for i in range(1, len(self.sequenceA)+1):
+                self.optimal[i][0] = 0
+                self.direction[i][0] = self.UP
 
-        for i in range(1, len(self.sequenceA)+1):
-            self.optimal[i][0] = 0
-            self.direction[i][0] = self.UP
+            for i in range(1, len(self.sequenceB)+1):
+                self.optimal[0][i] = 0
+                self.direction[0][i] = self.LEFT
 
-        for i in range(1, len(self.sequenceB)+1):
-            self.optimal[0][i] = 0
-            self.direction[0][i] = self.LEFT
+        self.fill_rows(first_row)
 
+    def fill_rows(self, first_row):
+        """
+        Computes the cells of rows first_row onwards, the rows above already filled
+        """
         # Compute the rest of the cells
-        for i in range(1, len(self.sequenceA)+1):
+        for i in range(first_row, len(self.sequenceA)+1):
+            # Scores of pairing symbol i with each symbol of sequenceB
+            scores = self.substitution_matrix.scores[self.codes_a[i-1]]
+            # Taken once per row, indexing the matrix for each cell builds a new row view
+            direction_row = self.direction[i]
             for j in range(1, len(self.sequenceB)+1):
 
-                if self.sequenceA[i-1] == self.sequenceB[j-1]:
-                    score_diagonal = self.optimal[i - 1][j - 1] + self.match_cost  # If Symbols Match
-                else:
-                    score_diagonal = self.optimal[i - 1][j - 1] + self.substitution  # Otherwise Substitute
+                score_diagonal = self.optimal[i - 1][j - 1] + scores[self.codes_b[j-1]]  # Match or Substitute
 
                 score_left = self.optimal[i][j - 1] + self.insert
                 score_up = self.optimal[i - 1][j] + self.delete
@@ -81,115 +204,258 @@ class SmithWaterman:
                                          score_diagonal,  # Score of going Diagonal
                                          score_left,  # Score of going Left
                                          score_up)  # Score of going Up
-                self.direction[i][j] = 0
+                direction = 0
                 if self.optimal[i][j] == score_left:
-                    self.direction[i][j] += self.LEFT
+                    direction += self.LEFT
                 if self.optimal[i][j] == score_diagonal:
-                    self.direction[i][j] += self.DIAGONAL
+                    direction += self.DIAGONAL
                 if self.optimal[i][j] == score_up:
-                    self.direction[i][j] += self.UP
+                    direction += self.UP
+                direction_row[j] = direction
 
                 if self.optimal[i][j] > self.max_value:
                     self.max_value = self.optimal[i][j]
                     self.max_indices = [i, j]
                 # end of align
+            if self.checkpoint is not None:
+                self.checkpoint.completed_row(i, {"max_value": self.max_value,
+                                                  "max_indices": self.max_indices})
 
-    def output_matrices(self):
+    def output_matrices(self, output_file=None, window=matrix_export.DEFAULT_WINDOW, around="end"):
         """
         Prints out Optimal and Direction Matrices
+        Matrices larger than window are cut down to the cells around the best cell,
+            or around the first traceback path with around="path"
         """
+        matrix_export.write_matrices(self, output_file, window, around)
+
+    def is_alignment_start(self, d, a):
+        return self.optimal[d][a] == 0
 
+    def iterate_alignments(self, limit=None):
         """
-        Print Optimal Matrix
+        Lazily yields (top, bottom) for each co-optimal local alignment, at most limit of them
         """
-        print("\n", "_"*7, "Optimal Matrix", "_"*7)
-        print("\t\t" + "\t".join(list(self.sequenceB)))
-        for i in range(0, len(self.sequenceA)+1):
-
-            if i >= 1:
-                print(self.sequenceA[i-1] + '\t', end="")
-            else:
-                print('\t', end="")
-            for j in range(0, len(self.sequenceB)+1):
-                print(str(self.optimal[i][j]) + '\t', end=""),
-            print("")
+        for top, bottom, d, a in alignment_paths.iterate_alignments(
+                self, self.max_indices[0], self.max_indices[1], self.is_alignment_start, limit, self.stats):
+            yield top, bottom
 
+    def count_alignments(self):
         """
-        Print Direction Matrix
+        Number of co-optimal local alignments, counted without walking each of them
         """
-        print("\n", "_"*7, "Direction Matrix", "_"*7)
-        print("\t\t" + "\t".join(list(self.sequenceB)))
-        for i in range(0, len(self.sequenceA)+1):
-            if i >= 1:
-                print(self.sequenceA[i-1] + '\t', end=""),
-            else:
-                print('\t', end=""),
-            for j in range(0, len(self.sequenceB)+1):
-                print(str(self.direction[i][j]) + '\t', end=""),
-            print("")
+        return alignment_paths.count_alignments(
+            self, self.max_indices[0], self.max_indices[1], self.is_alignment_start, self.stats)
 
-    def recurse_tree(self, d, a, tail_top, tail_bottom):
+    def recurse_tree(self, d, a, tail_top, tail_bottom, limit=None):
         """
         Follows Arrows Through Direction Matrix From End to Origin
         If a cell has multiple arrows, paths diverge and alignment is
             found for each possible path
+        Paths are walked with an explicit stack and printed as they are found
         """
-
-        if self.optimal[d][a] == 0:
-            print("\nAligning : %s, %s" % (self.sequenceA, self.sequenceB))
-            print(">>> Local Alignment: \n>>> %s\n>>> %s" % (tail_top, tail_bottom))
-            print("")
-
-        else:
-            tc = ''
-            if d >= 0:
-                tc = self.sequenceA[d-1]
-            bc = ''
-            if a >= 0:
-                bc = self.sequenceB[a-1]
-
-            if (self.direction[d][a] & self.LEFT) == self.LEFT:  # If Left Arrow
-                self.recurse_tree(d, a - 1, '-' + tail_top, bc + tail_bottom)
-
-            if (self.direction[d][a] & self.DIAGONAL) == self.DIAGONAL:  # If Diagonal Arrow
-                self.recurse_tree(d - 1, a - 1, tc + tail_top, bc + tail_bottom)
-
-            if (self.direction[d][a] & self.UP) == self.UP:  # If Up Arrow
-                self.recurse_tree(d - 1, a, tc + tail_top, '-' + tail_bottom)
-
-    def print_alignments(self):
-        self.recurse_tree(self.max_indices[0], self.max_indices[1], '', '')
+        with phase(self.stats, "traceback"):
+            for top, bottom, start_d, start_a in alignment_paths.iterate_alignments(
+                    self, d, a, self.is_alignment_start, limit, self.stats):
+                print("\nAligning : %s, %s" % (self.sequenceA, self.sequenceB))
+                print(">>> Local Alignment: \n>>> %s\n>>> %s" % (top + tail_top, bottom + tail_bottom))
+                print("")
+
+    def print_alignments(self, limit=None):
+        self.recurse_tree(self.max_indices[0], self.max_indices[1], '', '', limit)
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Local alignment of consecutive pairs of sequences")
+    # Aligns the sequences from the lecture slides by default
+    parser.add_argument("input_file", nargs="?", default="example.txt",
+                        help="file in the inputs folder")
+    parser.add_argument("--batch", metavar="OUTPUT_FILE", default=None,
+                        help="write one result record per pair to this file instead of printing")
+    parser.add_argument("--format", choices=("tsv", "jsonl"), default=None,
+                        help="batch record format, taken from the output file extension by default")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="batch worker processes, one per CPU by default")
+    parser.add_argument("--max-in-flight", type=int, default=256,
+                        help="pairs queued on the workers at once in batch mode")
+    parser.add_argument("--cache", metavar="CACHE_FILE", default=None,
+                        help="SQLite file keeping batch results between runs")
+    parser.add_argument("--matrix", default=None, metavar="NAME",
+                        help="score symbol pairs with a substitution matrix from the matrices folder, "
+                             "such as DNA or BLOSUM62, or in the file NAME")
+    parser.add_argument("--matrix-window", type=int, default=matrix_export.DEFAULT_WINDOW,
+                        help="largest number of matrix rows and columns printed, 0 prints them all")
+    parser.add_argument("--dump-matrices", metavar="PREFIX", default=None,
+                        help="save the full matrices to PREFIX_optimal.npy and PREFIX_direction.npy")
+    parser.add_argument("--matrix-dir", default=None,
+                        help="keep each pair's matrices in files under this directory, resuming an interrupted run")
+    parser.add_argument("--stats", nargs="?", const="-", default=None, metavar="JSON_FILE",
+                        help="print phase timings and work counts, or write them to JSON_FILE")
+    return parser.parse_args()
 
 
 def main():
-    try:
-        file_name = sys.argv[1]
-    except IndexError:
-        # Aligns the sequences from the lecture slides
-        file_name = "example.txt"
-
-    with open(os.path.join('inputs', file_name)) as input_file:
-        while True:
-            sequence_a = input_file.readline().rstrip()
-            sequence_b = input_file.readline().rstrip()
-            if len(sequence_a) > 0 and len(sequence_b) > 0:
-                align_sequences(sequence_a, sequence_b)
-            else:
-                break
-
-
-def align_sequences(sequence_a, sequence_b):
+    arguments = parse_arguments()
+    stats = AlignmentStats() if arguments.stats else None
+    pairs = iterate_pairs(os.path.join('inputs', arguments.input_file))
+
+    if arguments.batch:
+        output_format = arguments.format
+        if output_format is None:
+            output_format = "jsonl" if arguments.batch.endswith((".jsonl", ".json")) else "tsv"
+        # Workers do not report their own phases, so batch runs are timed as a whole
+        cache = None
+        if arguments.cache:
+            cache = AlignmentCache(path=arguments.cache, stats=stats)
+        with phase(stats, "batch"):
+            with open(arguments.batch, "w") as output_file:
+                write_batch(pairs, output_file, output_format,
+                            workers=arguments.workers,
+                            max_in_flight=arguments.max_in_flight,
+                            cache=cache,
+                            matrix_name=arguments.matrix)
+        if cache is not None:
+            cache.close()
+    else:
+        substitution_matrix = None
+        if arguments.matrix:
+            substitution_matrix = load_matrix(arguments.matrix)
+        for pair_number, (sequence_a, sequence_b) in enumerate(pairs, 1):
+            matrix_directory = None
+            if arguments.matrix_dir:
+                matrix_directory = os.path.join(arguments.matrix_dir, "pair_%d" % pair_number)
+            smith_waterman = align_sequences(sequence_a, sequence_b, stats,
+                                             matrix_window=arguments.matrix_window or None,
+                                             matrix_directory=matrix_directory,
+                                             substitution_matrix=substitution_matrix)
+            if arguments.dump_matrices:
+                matrix_export.save_matrices(smith_waterman, "%s_%d" % (arguments.dump_matrices, pair_number))
+
+    if stats is not None:
+        stats.report(arguments.stats)
+
+
+def align_sequences(sequence_a, sequence_b, stats=None, matrix_window=matrix_export.DEFAULT_WINDOW,
+                    matrix_directory=None, substitution_matrix=None):
     print("_"*10, "Sequence Alignment", "_"*10)
     smith_waterman = SmithWaterman(sequence_a=sequence_a,
                                    sequence_b=sequence_b,
                                    insertion_cost=-1,
                                    deletion_cost=-1,
                                    substitution_cost=-3,
-                                   match_cost=1)
+                                   match_cost=1,
+                                   stats=stats,
+                                   matrix_directory=matrix_directory,
+                                   substitution_matrix=substitution_matrix)
     smith_waterman.align()
-    smith_waterman.output_matrices()
+    smith_waterman.output_matrices(window=matrix_window)
     smith_waterman.print_alignments()
     print("#", "_"*9, "End Sequence Alignment", "_"*9, "#", "\n"*10)
+    return smith_waterman
+
+
+def align_pair(pair, matrix_name=None):
+    """
+    Aligns one pair without printing and returns its compact result record
+    The alignment strings are those of the first co-optimal alignment
+    matrix_name names the substitution matrix to score with, loaded once per worker
+    """
+    sequence_a, sequence_b = pair
+    substitution_matrix = None
+    if matrix_name is not None:
+        substitution_matrix = load_matrix(matrix_name)
+    smith_waterman = SmithWaterman(sequence_a=sequence_a,
+                                   sequence_b=sequence_b,
+                                   insertion_cost=-1,
+                                   deletion_cost=-1,
+                                   substitution_cost=-3,
+                                   match_cost=1,
+                                   verbose=False,
+                                   substitution_matrix=substitution_matrix)
+    smith_waterman.align()
+
+    end_a, end_b = smith_waterman.max_indices
+    alignment_a, alignment_b, start_a, start_b = next(alignment_paths.iterate_alignments(
+        smith_waterman, end_a, end_b, smith_waterman.is_alignment_start, limit=1))
+    return {"sequence_a": sequence_a,
+            "sequence_b": sequence_b,
+            "score": smith_waterman.max_value,
+            "start_a": start_a,
+            "start_b": start_b,
+            "end_a": end_a,
+            "end_b": end_b,
+            "alignment_a": alignment_a,
+            "alignment_b": alignment_b}
+
+
+class CachedResult:
+    """
+    Stands in for the AsyncResult of a pair found in the cache
+    """
+    def __init__(self, result):
+        self.result = result
+
+    def get(self):
+        return self.result
+
+
+def align_pairs_parallel(pairs, workers=None, max_in_flight=256, cache=None, matrix_name=None):
+    """
+    Lazily yields align_pair results in input order from a pool of worker processes
+    At most max_in_flight pairs are submitted ahead of the result being written,
+        so memory stays bounded however many pairs the input holds
+    Pairs found in cache are not submitted, and new results are added to it
+    The pool is only started once a pair is missing from the cache
+    """
+    pool = None
+    try:
+        # Each entry is (cache key, result), the key is None when there is nothing to store
+        pending = collections.deque()
+        for pair in pairs:
+            key = None
+            result = None
+            if cache is not None:
+                algorithm = "align_pair"
+                if matrix_name is not None:
+                    algorithm += " " + matrix_name
+                key = cache_key(algorithm, pair[0], pair[1], -1, -1, -3, 1)
+                result = cache.get(key)
+            if result is not None:
+                pending.append((None, CachedResult(result)))
+            else:
+                if pool is None:
+                    pool = multiprocessing.Pool(workers)
+                pending.append((key, pool.apply_async(align_pair, (pair, matrix_name))))
+            if len(pending) >= max_in_flight:
+                yield collect_result(pending.popleft(), cache)
+        while pending:
+            yield collect_result(pending.popleft(), cache)
+    finally:
+        if pool is not None:
+            pool.terminate()
+
+
+def collect_result(entry, cache):
+    """
+    Waits for a pending result, adding it to the cache when it was computed
+    """
+    key, pending_result = entry
+    result = pending_result.get()
+    if key is not None:
+        cache.put(key, result)
+    return result
+
+
+def write_batch(pairs, output_file, output_format="tsv", workers=None, max_in_flight=256, cache=None,
+                matrix_name=None):
+    if output_format == "tsv":
+        output_file.write("\t".join(RESULT_FIELDS) + "\n")
+    for result in align_pairs_parallel(pairs, workers, max_in_flight, cache, matrix_name):
+        if output_format == "tsv":
+            output_file.write("\t".join(str(result[field]) for field in RESULT_FIELDS) + "\n")
+        else:
+            output_file.write(json.dumps(result) + "\n")
+
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,196 @@
+import os
+import collections
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+"""
+Substitution matrices scoring each pair of symbols in the aligners' inner loops
+
+Sequences are encoded once into bytes, one small integer code per symbol, and
+the diagonal score of two symbols is scores[code_a][code_b] instead of a
+comparison choosing between match_cost and substitution. Encoded sequences are
+kept by the matrix, so a template aligned against many reads is only encoded
+once.
+
+identity_matrix(match, mismatch) reproduces the plain match_cost and
+substitution costs, its alphabet grows with the symbols it is given. Scoring
+tables in NCBI format, such as the bundled DNA and BLOSUM62 ones in the
+matrices folder, are read by load_matrix.
+"""
+
+MATRIX_DIRECTORY = os.path.join(os.path.dirname(os.path.realpath(__file__)), "matrices")
+
+# Encoded sequences remembered by each matrix
+ENCODED_CACHE_SIZE = 64
+
+# Codes have to fit in a byte
+MAX_SYMBOLS = 256
+
+
+class SubstitutionMatrix:
+    def __init__(self, name, alphabet, scores, extendable=False, identity_scores=None):
+        self.name = name
+        self.alphabet = alphabet
+        self.codes = dict((symbol, code) for code, symbol in enumerate(alphabet))
+        # scores[code_a][code_b] is the score of aligning the two symbols
+        self.scores = [list(row) for row in scores]
+
+        # An extendable matrix gives new symbols a code when they are first encoded
+        self.extendable = extendable
+        # (match, mismatch) of a matrix built by identity_matrix
+        self.identity_scores = identity_scores
+
+        self.encoded = collections.OrderedDict()
+        self.translation = self.translation_table()
+
+    def __getstate__(self):
+        # Worker processes rebuild the encoded sequences they need
+        state = dict(self.__dict__)
+        state["encoded"] = collections.OrderedDict()
+        return state
+
+    def translation_table(self):
+        return dict((ord(symbol), chr(code)) for symbol, code in self.codes.items())
+
+    def add_symbol(self, symbol):
+        if len(self.alphabet) >= MAX_SYMBOLS:
+            raise ValueError("A substitution matrix holds at most %d symbols" % MAX_SYMBOLS)
+        match, mismatch = self.identity_scores
+        for row in self.scores:
+            row.append(mismatch)
+        self.scores.append([mismatch] * len(self.alphabet) + [match])
+        self.codes[symbol] = len(self.alphabet)
+        self.alphabet += symbol
+        self.translation[ord(symbol)] = chr(self.codes[symbol])
+
+    def encode(self, sequence, remember=True):
+        """
+        Returns the codes of sequence as bytes, indexing them gives integer codes
+        With remember the result is kept, and returned again for the same sequence
+        """
+        encoded = self.encoded.get(sequence)
+        if encoded is not None:
+            self.encoded.move_to_end(sequence)
+            return encoded
+
+        unknown = set(sequence).difference(self.codes)
+        if unknown:
+            if not self.extendable:
+                raise ValueError("Symbols %s are not in substitution matrix %s" %
+                                 ("".join(sorted(unknown)), self.name))
+            for symbol in sorted(unknown):
+                self.add_symbol(symbol)
+        encoded = sequence.translate(self.translation).encode("latin-1")
+
+        if remember:
+            self.encoded[sequence] = encoded
+            while len(self.encoded) > ENCODED_CACHE_SIZE:
+                self.encoded.popitem(last=False)
+        return encoded
+
+    def score(self, symbol_a, symbol_b):
+        """
+        Score of aligning two single symbols
+        """
+        code_a, code_b = self.encode(symbol_a + symbol_b, remember=False)
+        return self.scores[code_a][code_b]
+
+    def best_score(self):
+        if self.identity_scores is not None:
+            return max(self.identity_scores)
+        return max(max(row) for row in self.scores)
+
+    def lowest_score(self):
+        if self.identity_scores is not None:
+            return min(self.identity_scores)
+        return min(min(row) for row in self.scores)
+
+    def has_float_scores(self):
+        """
+        True when any score is a float, so scores summed with it have to be kept as floats
+        """
+        if self.identity_scores is not None:
+            return any(isinstance(score, float) for score in self.identity_scores)
+        return any(isinstance(score, float) for row in self.scores for score in row)
+
+    def positive_columns(self, encoded_b):
+        """
+        For each code, the columns j (1 based) of encoded_b where it scores above 0
+        """
+        columns = {}
+        for code, row in enumerate(self.scores):
+            columns[code] = [j for j, code_b in enumerate(encoded_b, 1) if row[code_b] > 0]
+        return columns
+
+    def table(self):
+        """
+        The scores as a NumPy array
+        """
+        if np is None:
+            raise ImportError("table requires NumPy to be installed")
+        return np.array(self.scores)
+
+    def negated(self):
+        """
+        The same matrix with every score negated, turning similarity scores into the
+            costs minimised by NeedlemanWunch
+        """
+        identity_scores = None
+        if self.identity_scores is not None:
+            identity_scores = (-self.identity_scores[0], -self.identity_scores[1])
+        return SubstitutionMatrix("-" + self.name, self.alphabet,
+                                  [[-score for score in row] for row in self.scores],
+                                  self.extendable, identity_scores)
+
+
+# Shared matrices, so every aligner using the same scores shares the encoded sequences
+identity_matrices = {}
+loaded_matrices = {}
+
+
+def identity_matrix(match, mismatch):
+    """
+    Matrix scoring match for equal symbols and mismatch otherwise, over any symbols
+    """
+    key = (type(match), match, type(mismatch), mismatch)
+    if key not in identity_matrices:
+        identity_matrices[key] = SubstitutionMatrix("identity(%r, %r)" % (match, mismatch), "", [],
+                                                    extendable=True, identity_scores=(match, mismatch))
+    return identity_matrices[key]
+
+
+def read_matrix(file_name, name=None):
+    """
+    Reads a matrix in NCBI format, '#' comment lines, a header line of symbols,
+        then one line per symbol holding it and its scores
+    """
+    rows = []
+    with open(file_name) as matrix_file:
+        for line in matrix_file:
+            line = line.split("#", 1)[0].split()
+            if line:
+                rows.append(line)
+    alphabet = "".join(rows[0])
+    scores = [[0] * len(alphabet) for symbol in alphabet]
+    codes = dict((symbol, code) for code, symbol in enumerate(alphabet))
+    for row in rows[1:]:
+        if row[0] not in codes or len(row) != len(alphabet) + 1:
+            raise ValueError("Malformed substitution matrix row in %s: %s" % (file_name, " ".join(row)))
+        scores[codes[row[0]]] = [int(score) for score in row[1:]]
+    return SubstitutionMatrix(name or os.path.basename(file_name), alphabet, scores)
+
+
+def load_matrix(name):
+    """
+    Returns the bundled matrix called name, such as "DNA" or "BLOSUM62", or the
+        matrix in the file name
+    """
+    if name not in loaded_matrices:
+        file_name = os.path.join(MATRIX_DIRECTORY, name)
+        if not os.path.exists(file_name):
+            file_name = name
+        loaded_matrices[name] = read_matrix(file_name, name)
+    return loaded_matrices[name]
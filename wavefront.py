@@ -0,0 +1,166 @@
+import array
+import weakref
+import multiprocessing
+from multiprocessing import shared_memory
+
+"""
+Tiled wavefront fill of a NeedlemanWunch Optimal and Direction Matrix on a
+pool of worker processes
+
+The matrix is cut into tiles of tile_size rows and columns. A tile only needs
+the row above it and the column left of it, so every tile on one anti-diagonal
+of the tile grid can be filled at the same time once the previous
+anti-diagonal is done. Both matrices are allocated in shared memory blocks
+owned by the aligner, which the workers attach to once and fill in place, so
+tile boundaries are read straight from the cells written by the neighbouring
+tiles, nothing but tile coordinates is sent to a worker and the matrices are
+never copied.
+Each cell is computed exactly as NeedlemanWunch.align_python does, so the
+result, direction tie bits included, is the same as the serial fill.
+"""
+
+# Rows and columns of one tile
+DEFAULT_TILE_SIZE = 256
+
+
+class BufferMatrix:
+    """
+    Matrix stored row by row in one flat buffer, indexed like a list of lists
+    """
+    def __init__(self, buffer, rows, columns, typecode):
+        self.rows = rows
+        self.columns = columns
+        self.typecode = typecode
+        self.buffer = buffer
+        self.view = memoryview(buffer).cast("B").cast(typecode)
+
+    def __len__(self):
+        return self.rows
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self.rows
+        if not 0 <= i < self.rows:
+            raise IndexError("matrix row out of range")
+        return self.view[i * self.columns:(i + 1) * self.columns]
+
+    def tolist(self):
+        return [list(self[i]) for i in range(self.rows)]
+
+    @property
+    def nbytes(self):
+        return self.view.nbytes
+
+
+def new_matrix(rows, columns, typecode):
+    """
+    Returns a zeroed BufferMatrix in a new shared memory block, kept as its block
+    The block is unlinked once the matrix is garbage collected, or at exit
+    """
+    size = rows * columns * array.array(typecode).itemsize
+    block = shared_memory.SharedMemory(create=True, size=size)
+    matrix = BufferMatrix(block.buf[:size], rows, columns, typecode)
+    matrix.block = block
+    weakref.finalize(matrix, unlink_block, block)
+    return matrix
+
+
+def unlink_block(block):
+    # Views of the matrix rows still held keep the memory mapped, only the name goes
+    try:
+        block.unlink()
+    except FileNotFoundError:
+        pass
+
+
+# Per process state of a wavefront worker, set once by init_worker
+worker_blocks = None
+worker_problem = None
+
+
+def init_worker(optimal_name, direction_name, problem):
+    global worker_blocks, worker_problem
+    # Workers share the parent's resource tracker, the parent unlinks the blocks
+    worker_blocks = (shared_memory.SharedMemory(name=optimal_name),
+                     shared_memory.SharedMemory(name=direction_name))
+    worker_problem = problem
+
+
+def fill_tile(tile):
+    """
+    Fills rows first_row to last_row-1 and columns first_column to last_column-1
+    """
+    first_row, last_row, first_column, last_column = tile
+    (codes_a, codes_b, columns, typecode,
+     insert, delete, scores, left, diagonal, up) = worker_problem
+    optimal = worker_blocks[0].buf.cast(typecode)
+    direction = worker_blocks[1].buf
+    try:
+        fill_cells(optimal, direction, codes_a, codes_b, columns,
+                   insert, delete, scores, left, diagonal, up,
+                   first_row, last_row, first_column, last_column)
+    finally:
+        optimal.release()
+
+
+def fill_cells(optimal, direction, codes_a, codes_b, columns,
+               insert, delete, scores, left, diagonal, up,
+               first_row, last_row, first_column, last_column):
+    for i in range(first_row, last_row):
+        row = i * columns
+        above = row - columns
+        row_scores = scores[codes_a[i-1]]
+        for j in range(first_column, last_column):
+            score_diagonal = optimal[above + j - 1] + row_scores[codes_b[j-1]]
+
+            score_left = optimal[row + j - 1] + insert
+            score_up = optimal[above + j] + delete
+
+            score = min(score_diagonal, score_left, score_up)
+            optimal[row + j] = score
+
+            arrows = 0
+            if score == score_left:
+                arrows += left
+            if score == score_diagonal:
+                arrows += diagonal
+            if score == score_up:
+                arrows += up
+            direction[row + j] = arrows
+
+
+def wavefronts(rows, columns, tile_size):
+    """
+    Yields the tiles of each anti-diagonal of the tile grid in turn, row 0 and
+        column 0 excluded as they are filled beforehand
+    """
+    row_starts = list(range(1, rows, tile_size))
+    column_starts = list(range(1, columns, tile_size))
+    for wave in range(len(row_starts) + len(column_starts) - 1):
+        tiles = []
+        for tile_row in range(max(0, wave - len(column_starts) + 1), min(wave + 1, len(row_starts))):
+            first_row = row_starts[tile_row]
+            first_column = column_starts[wave - tile_row]
+            tiles.append((first_row, min(first_row + tile_size, rows),
+                          first_column, min(first_column + tile_size, columns)))
+        yield tiles
+
+
+def fill_wavefront(aligner, workers=None, tile_size=DEFAULT_TILE_SIZE):
+    """
+    Fills the matrices optimal and direction of a NeedlemanWunch aligner, made by
+        new_matrix with row 0 and column 0 already set, on workers processes
+    """
+    optimal = aligner.optimal
+    direction = aligner.direction
+    rows, columns = optimal.rows, optimal.columns
+    if rows < 2 or columns < 2:
+        return
+
+    problem = (aligner.codes_a, aligner.codes_b, columns, optimal.typecode,
+               aligner.insert, aligner.delete, aligner.substitution_matrix.scores,
+               aligner.LEFT, aligner.DIAGONAL, aligner.UP)
+    with multiprocessing.Pool(workers, initializer=init_worker,
+                              initargs=(optimal.block.name, direction.block.name, problem)) as pool:
+        for tiles in wavefronts(rows, columns, tile_size):
+            pool.map(fill_tile, tiles, chunksize=1)